@@ -0,0 +1,174 @@
+// Copyright 2008 the V8 project authors. All rights reserved.
+// Redistribution and use in source and binary forms, with or without
+// modification, are permitted provided that the following conditions are
+// met:
+//
+//     * Redistributions of source code must retain the above copyright
+//       notice, this list of conditions and the following disclaimer.
+//     * Redistributions in binary form must reproduce the above
+//       copyright notice, this list of conditions and the following
+//       disclaimer in the documentation and/or other materials provided
+//       with the distribution.
+//     * Neither the name of Google Inc. nor the names of its
+//       contributors may be used to endorse or promote products derived
+//       from this software without specific prior written permission.
+//
+// THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+// "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+// LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+// A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+// OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+// SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+// LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+// DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+// THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+// (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+// OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#ifndef V8_FORK_SERVER_H_
+#define V8_FORK_SERVER_H_
+
+// The fork server shared by the shell and cctest.  A fork server reads
+// requests from stdin, one per line, and handles each of them in a
+// child process forked from the server so the cost of starting the
+// process is only paid once while a crash still only takes down the
+// child.  For each request the server writes
+//
+//   pid <pid>          the process handling the request
+//   out <n>            followed by n bytes written by the child to stdout
+//   err <n>            followed by n bytes written by the child to stderr
+//   status <code> <user> <system> <rss>
+//                      the exit code, or minus the signal that killed it,
+//                      followed by the user and system CPU time used in
+//                      seconds and the peak resident set size as reported
+//                      by getrusage
+//
+// to stdout, with any number of out and err records.  tools/test.py
+// reads this protocol in its ForkServer class.
+
+#ifndef _WIN32
+
+#include <errno.h>
+#include <sys/resource.h>
+#include <sys/select.h>
+#include <sys/time.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <unistd.h>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+
+// Handles a request in the child.  The return value is the exit code
+// of the child.
+typedef int (*ForkServerHandler)(const char* request, void* data);
+
+
+// Forwards whatever can be read from the given pipe as a single out or
+// err record.  Returns false once the pipe has been closed.
+inline bool ForkServerForwardOutput(int fd, const char* tag) {
+  static const int kBufferSize = 4096;
+  char buffer[kBufferSize];
+  int count;
+  do {
+    count = read(fd, buffer, kBufferSize);
+  } while (count < 0 && errno == EINTR);
+  if (count <= 0) return false;
+  printf("%s %i\n", tag, count);
+  fwrite(buffer, 1, count, stdout);
+  return true;
+}
+
+
+// Runs the handler for a single request in a child and relays its
+// output and exit status.  Only returns in the server.
+inline void ForkServerRunRequest(const char* request,
+                                 ForkServerHandler handler,
+                                 void* data) {
+  int out[2];
+  int err[2];
+  if (pipe(out) != 0 || pipe(err) != 0) {
+    perror("pipe");
+    exit(1);
+  }
+  fflush(stdout);
+  fflush(stderr);
+  pid_t pid = fork();
+  if (pid < 0) {
+    perror("fork");
+    exit(1);
+  }
+  if (pid == 0) {
+    // Give the child its own process group so the test runner can kill
+    // it, and anything it spawns, without killing the server.
+    setpgid(0, 0);
+    dup2(out[1], STDOUT_FILENO);
+    dup2(err[1], STDERR_FILENO);
+    close(out[0]);
+    close(out[1]);
+    close(err[0]);
+    close(err[1]);
+    int exit_code = handler(request, data);
+    fflush(stdout);
+    fflush(stderr);
+    exit(exit_code);
+  }
+  close(out[1]);
+  close(err[1]);
+  printf("pid %i\n", static_cast<int>(pid));
+  fflush(stdout);
+  bool out_open = true;
+  bool err_open = true;
+  while (out_open || err_open) {
+    fd_set fds;
+    FD_ZERO(&fds);
+    if (out_open) FD_SET(out[0], &fds);
+    if (err_open) FD_SET(err[0], &fds);
+    int max_fd = (out[0] > err[0]) ? out[0] : err[0];
+    if (select(max_fd + 1, &fds, NULL, NULL, NULL) < 0) {
+      if (errno == EINTR) continue;
+      perror("select");
+      exit(1);
+    }
+    if (out_open && FD_ISSET(out[0], &fds))
+      out_open = ForkServerForwardOutput(out[0], "out");
+    if (err_open && FD_ISSET(err[0], &fds))
+      err_open = ForkServerForwardOutput(err[0], "err");
+  }
+  close(out[0]);
+  close(err[0]);
+  int status;
+  struct rusage usage;
+  while (wait4(pid, &status, 0, &usage) < 0) {
+    if (errno != EINTR) {
+      perror("wait4");
+      exit(1);
+    }
+  }
+  int exit_code = WIFSIGNALED(status) ? -WTERMSIG(status) : WEXITSTATUS(status);
+  printf("status %i %d.%06d %d.%06d %d\n", exit_code,
+         static_cast<int>(usage.ru_utime.tv_sec),
+         static_cast<int>(usage.ru_utime.tv_usec),
+         static_cast<int>(usage.ru_stime.tv_sec),
+         static_cast<int>(usage.ru_stime.tv_usec),
+         static_cast<int>(usage.ru_maxrss));
+  fflush(stdout);
+}
+
+
+// Reads requests from stdin until it is closed, handling each in a
+// child of its own.
+inline void ForkServerRun(ForkServerHandler handler, void* data) {
+  static const int kBufferSize = 1024;
+  char buffer[kBufferSize];
+  while (fgets(buffer, kBufferSize, stdin) != NULL) {
+    char* newline = strchr(buffer, '\n');
+    if (newline) *newline = 0;
+    if (*buffer == 0) continue;
+    ForkServerRunRequest(buffer, handler, data);
+  }
+}
+
+#endif  // _WIN32
+
+#endif  // V8_FORK_SERVER_H_
@@ -29,6 +29,7 @@
 #include <cstring>
 #include <cstdio>
 #include <cstdlib>
+#include "fork-server.h"
 
 
 void RunShell(v8::Handle<v8::Context> context);
@@ -36,12 +37,16 @@ bool ExecuteString(v8::Handle<v8::String> source,
                    v8::Handle<v8::Value> name,
                    bool print_result,
                    bool report_exceptions);
+bool ExecuteFile(const char* name);
 v8::Handle<v8::Value> Print(const v8::Arguments& args);
 v8::Handle<v8::Value> Load(const v8::Arguments& args);
 v8::Handle<v8::Value> Quit(const v8::Arguments& args);
 v8::Handle<v8::Value> Version(const v8::Arguments& args);
 v8::Handle<v8::String> ReadFile(const char* name);
 void ReportException(v8::TryCatch* handler);
+bool IsForkServer(int argc, char* argv[]);
+int RunForkServer(int argc, char* argv[],
+                  v8::Handle<v8::ObjectTemplate> global);
 
 
 int main(int argc, char* argv[]) {
@@ -57,6 +62,8 @@ int main(int argc, char* argv[]) {
   global->Set(v8::String::New("quit"), v8::FunctionTemplate::New(Quit));
   // Bind the 'version' function
   global->Set(v8::String::New("version"), v8::FunctionTemplate::New(Version));
+  if (IsForkServer(argc, argv))
+    return RunForkServer(argc, argv, global);
   // Create a new execution environment containing the built-in
   // functions
   v8::Handle<v8::Context> context = v8::Context::New(NULL, global);
@@ -75,14 +82,7 @@ int main(int argc, char* argv[]) {
       printf("Warning: unknown flag %s.\n", str);
     } else {
       // Use all other arguments as names of files to load and run.
-      v8::HandleScope handle_scope;
-      v8::Handle<v8::String> file_name = v8::String::New(str);
-      v8::Handle<v8::String> source = ReadFile(str);
-      if (source.IsEmpty()) {
-        printf("Error reading '%s'\n", str);
-        return 1;
-      }
-      if (!ExecuteString(source, file_name, false, true))
+      if (!ExecuteFile(str))
         return 1;
     }
   }
@@ -91,6 +91,88 @@ int main(int argc, char* argv[]) {
 }
 
 
+// Loads and runs a file in the current context, reporting any errors.
+bool ExecuteFile(const char* name) {
+  v8::HandleScope handle_scope;
+  v8::Handle<v8::String> file_name = v8::String::New(name);
+  v8::Handle<v8::String> source = ReadFile(name);
+  if (source.IsEmpty()) {
+    printf("Error reading '%s'\n", name);
+    return false;
+  }
+  return ExecuteString(source, file_name, false, true);
+}
+
+
+bool IsForkServer(int argc, char* argv[]) {
+  for (int i = 1; i < argc; i++) {
+    if (strcmp(argv[i], "--fork-server") == 0)
+      return true;
+  }
+  return false;
+}
+
+
+#ifndef _WIN32
+
+// In fork server mode the shell runs each file read from stdin in a
+// child forked from the shell, in a fresh context after the files given
+// on the command line.  The child exits with status 1 if any of them
+// throws.  See fork-server.h for the protocol.
+
+
+struct ShellRequestData {
+  int argc;
+  char** argv;
+  v8::Handle<v8::ObjectTemplate> global;
+};
+
+
+// Runs the preloaded files followed by the given file in a new context.
+int RunFile(const char* name, void* data) {
+  ShellRequestData* shell = static_cast<ShellRequestData*>(data);
+  v8::HandleScope handle_scope;
+  v8::Handle<v8::Context> context = v8::Context::New(NULL, shell->global);
+  v8::Context::Scope context_scope(context);
+  for (int i = 1; i < shell->argc; i++) {
+    if (strncmp(shell->argv[i], "--", 2) == 0) continue;
+    if (!ExecuteFile(shell->argv[i])) return 1;
+  }
+  if (!ExecuteFile(name)) return 1;
+  return 0;
+}
+
+
+int RunForkServer(int argc, char* argv[],
+                  v8::Handle<v8::ObjectTemplate> global) {
+  {
+    // Run the preloaded files once in the server so the VM is set up
+    // and their code is compiled before the first child is forked.
+    v8::HandleScope handle_scope;
+    v8::Handle<v8::Context> context = v8::Context::New(NULL, global);
+    v8::Context::Scope context_scope(context);
+    for (int i = 1; i < argc; i++) {
+      if (strncmp(argv[i], "--", 2) == 0) continue;
+      if (!ExecuteFile(argv[i]))
+        return 1;
+    }
+  }
+  ShellRequestData data = { argc, argv, global };
+  ForkServerRun(RunFile, &data);
+  return 0;
+}
+
+#else  // _WIN32
+
+int RunForkServer(int argc, char* argv[],
+                  v8::Handle<v8::ObjectTemplate> global) {
+  printf("Fork server mode is not supported on this platform.\n");
+  return 1;
+}
+
+#endif  // _WIN32
+
+
 // The callback that is invoked by v8 whenever the JavaScript 'print'
 // function is called.  Prints its arguments on stdout separated by
 // spaces and ending with a newline.
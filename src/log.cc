@@ -101,6 +101,9 @@ class Profiler: public Thread {
   void Run();
 
  private:
+  // Logs a time marker if one is due.
+  void LogTimeMarker();
+
   // Returns the next index in the cyclic buffer.
   int Succ(int index) { return (index + 1) % kBufferSize; }
 
@@ -115,6 +118,11 @@ class Profiler: public Thread {
 
   // Tells whether worker thread should continue running.
   bool running_;
+
+  // The time the profiler was engaged and the time the next time marker
+  // is due, in microseconds.
+  int64_t start_time_;
+  int64_t next_time_marker_;
 };
 
 
@@ -198,12 +206,17 @@ Profiler::Profiler() {
   tail_ = 0;
   overflow_ = false;
   running_ = false;
+  start_time_ = 0;
+  next_time_marker_ = 0;
 }
 
 
 void Profiler::Engage() {
   OS::LogSharedLibraryAddresses();
 
+  start_time_ = OS::Ticks();
+  next_time_marker_ = start_time_;
+
   // Start thread processing the profiler buffer.
   running_ = true;
   Start();
@@ -238,12 +251,24 @@ void Profiler::Run() {
   TickSample sample;
   bool overflow = Logger::profiler_->Remove(&sample);
   while (running_) {
+    LogTimeMarker();
     LOG(TickEvent(&sample, overflow));
     overflow = Logger::profiler_->Remove(&sample);
   }
 }
 
 
+void Profiler::LogTimeMarker() {
+  // The buffer is drained as ticks arrive, so the time a tick is written
+  // is close to the time it was taken.
+  if (FLAG_prof_time_interval <= 0) return;
+  int64_t now = OS::Ticks();
+  if (now < next_time_marker_) return;
+  LOG(TimeMarkerEvent(static_cast<int>((now - start_time_) / 1000)));
+  next_time_marker_ = now + FLAG_prof_time_interval * 1000;
+}
+
+
 //
 // Logger class implementation.
 //
@@ -649,8 +674,18 @@ void Logger::TickEvent(TickSample* sample, bool overflow) {
   fprintf(logfile_, "tick,0x%x,0x%x,%d", sample->pc, sample->sp,
           static_cast<int>(sample->state));
   if (overflow) fprintf(logfile_, ",overflow");
+  for (int i = 0; i < sample->frames_count; ++i) {
+    fprintf(logfile_, ",0x%x", sample->stack[i]);
+  }
   fprintf(logfile_, "\n");
 }
+
+
+void Logger::TimeMarkerEvent(int time) {
+  if (logfile_ == NULL) return;
+  ScopedLock sl(mutex_);
+  fprintf(logfile_, "time-marker,%d\n", time);
+}
 #endif
 
 
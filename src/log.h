@@ -202,6 +202,10 @@ class Logger {
   // Emits a profiler tick event. Used by the profiler thread.
   static void TickEvent(TickSample* sample, bool overflow);
 
+  // Emits the milliseconds since the profiler was engaged. Used by the
+  // profiler thread to timestamp the ticks that follow.
+  static void TimeMarkerEvent(int time);
+
   static void ApiEvent(const char* name, ...);
 
   // When logging is active, logfile_ refers the file
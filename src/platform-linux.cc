@@ -601,6 +601,36 @@ Semaphore* OS::CreateSemaphore(int count) {
 
 static Sampler* active_sampler_ = NULL;
 
+#if !defined(__arm__) && !defined(__thumb__)
+// The thread running the VM and the highest address of its stack.  Both
+// are recorded when the sampler starts so the signal handler only has to
+// compare addresses.
+static pthread_t vm_thread_;
+static unsigned int vm_stack_top_ = 0;
+
+
+// Follows the chain of saved frame pointers starting at sample->fp and
+// records the return address of each frame.  Every frame must lie above
+// the previous one and below the top of the VM stack; anything else ends
+// the walk, so a frame in the middle of its prologue or code compiled
+// without frame pointers merely truncates the chain.
+static void SampleStack(TickSample* sample) {
+  unsigned int fp = sample->fp;
+  unsigned int limit = sample->sp;
+  int count = 0;
+  while (count < TickSample::kMaxFramesCount) {
+    if (fp < limit || fp > vm_stack_top_ - 2 * kPointerSize) break;
+    if ((fp & (kPointerSize - 1)) != 0) break;
+    unsigned int* frame = reinterpret_cast<unsigned int*>(fp);
+    sample->stack[count++] = frame[1];
+    limit = fp + 2 * kPointerSize;
+    fp = frame[0];
+  }
+  sample->frames_count = count;
+}
+#endif
+
+
 static void ProfilerSignalHandler(int signal, siginfo_t* info, void* context) {
   USE(info);
   if (signal != SIGPROF) return;
@@ -619,6 +649,12 @@ static void ProfilerSignalHandler(int signal, siginfo_t* info, void* context) {
 #else
     sample.pc = mcontext.gregs[REG_EIP];
     sample.sp = mcontext.gregs[REG_ESP];
+    sample.fp = mcontext.gregs[REG_EBP];
+    // SIGPROF is delivered to whichever thread is running; only the VM
+    // thread's stack bounds are known.
+    if (vm_stack_top_ != 0 && pthread_equal(pthread_self(), vm_thread_)) {
+      SampleStack(&sample);
+    }
 #endif
   }
 
@@ -657,6 +693,21 @@ void Sampler::Start() {
   // platforms.
   if (active_sampler_ != NULL) return;
 
+#if !defined(__arm__) && !defined(__thumb__)
+  // Remember the bounds of the VM stack for walking it on each tick.
+  vm_thread_ = pthread_self();
+  vm_stack_top_ = 0;
+  pthread_attr_t attr;
+  if (profiling_ && pthread_getattr_np(vm_thread_, &attr) == 0) {
+    void* base;
+    size_t size;
+    if (pthread_attr_getstack(&attr, &base, &size) == 0) {
+      vm_stack_top_ = reinterpret_cast<unsigned int>(base) + size;
+    }
+    pthread_attr_destroy(&attr);
+  }
+#endif
+
   // Request profiling signals.
   struct sigaction sa;
   sa.sa_sigaction = ProfilerSignalHandler;
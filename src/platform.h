@@ -408,10 +408,16 @@ class Semaphore {
 // TickSample captures the information collected for each sample.
 class TickSample {
  public:
-  TickSample() : pc(0), sp(0), state(OTHER) {}
+  TickSample() : pc(0), sp(0), fp(0), state(OTHER), frames_count(0) {}
   unsigned int pc;  // Instruction pointer.
   unsigned int sp;  // Stack pointer.
+  unsigned int fp;  // Frame pointer.
   StateTag state;   // The state of the VM.
+  // Return addresses of the calling frames, innermost first.  Only
+  // platforms that can walk the stack from a signal handler fill it in.
+  static const int kMaxFramesCount = 32;
+  unsigned int stack[kMaxFramesCount];
+  int frames_count;  // Number of valid entries in stack.
 };
 
 class Sampler {
@@ -30,6 +30,7 @@
 #include <cstring>
 #include <cstdio>
 #include "cctest.h"
+#include "fork-server.h"
 
 
 CcTest* CcTest::last_ = NULL;
@@ -66,6 +67,63 @@ static void PrintTestList(CcTest* current) {
 }
 
 
+// Runs the test or tests selected by the given argument and returns
+// the number of tests run.
+static int RunTests(const char* arg) {
+  int tests_run = 0;
+  char* arg_copy = v8::internal::OS::StrDup(arg);
+  char* testname = strchr(arg_copy, '/');
+  if (testname) {
+    // Split the string in two by nulling the slash and then run
+    // exact matches.
+    *testname = 0;
+    char* file = arg_copy;
+    char* name = testname + 1;
+    CcTest* test = CcTest::last();
+    while (test != NULL) {
+      if (test->enabled()
+          && strcmp(test->file(), file) == 0
+          && strcmp(test->name(), name) == 0) {
+        test->Run();
+        tests_run++;
+      }
+      test = test->prev();
+    }
+
+  } else {
+    // Run all tests with the specified file or test name.
+    char* file_or_name = arg_copy;
+    CcTest* test = CcTest::last();
+    while (test != NULL) {
+      if (test->enabled()
+          && (strcmp(test->file(), file_or_name) == 0
+              || strcmp(test->name(), file_or_name) == 0)) {
+        test->Run();
+        tests_run++;
+      }
+      test = test->prev();
+    }
+  }
+  free(arg_copy);
+  return tests_run;
+}
+
+
+#ifndef _WIN32
+
+// The fork server runs each test named on stdin in a child forked from
+// the server, so the cost of starting the process and parsing flags is
+// only paid once.  See fork-server.h for the protocol.
+static int RunForkedTest(const char* name, void* data) {
+  int tests_run = RunTests(name);
+  if (tests_run != 1)
+    printf("Ran %i tests.\n", tests_run);
+  return 0;
+}
+
+#endif  // _WIN32
+
+
 int main(int argc, char* argv[]) {
   v8::internal::FlagList::SetFlagsFromCommandLine(&argc, argv, true);
   int tests_run = 0;
@@ -76,41 +134,14 @@ int main(int argc, char* argv[]) {
       PrintTestList(CcTest::last());
       print_run_count = false;
 
+#ifndef _WIN32
+    } else if (strcmp(arg, "--fork-server") == 0) {
+      ForkServerRun(RunForkedTest, NULL);
+      print_run_count = false;
+#endif
+
     } else {
-      char* arg_copy = v8::internal::OS::StrDup(arg);
-      char* testname = strchr(arg_copy, '/');
-      if (testname) {
-        // Split the string in two by nulling the slash and then run
-        // exact matches.
-        *testname = 0;
-        char* file = arg_copy;
-        char* name = testname + 1;
-        CcTest* test = CcTest::last();
-        while (test != NULL) {
-          if (test->enabled()
-              && strcmp(test->file(), file) == 0
-              && strcmp(test->name(), name) == 0) {
-            test->Run();
-            tests_run++;
-          }
-          test = test->prev();
-        }
-
-      } else {
-        // Run all tests with the specified file or test name.
-        char* file_or_name = arg_copy;
-        CcTest* test = CcTest::last();
-        while (test != NULL) {
-          if (test->enabled()
-              && (strcmp(test->file(), file_or_name) == 0
-                  || strcmp(test->name(), file_or_name) == 0)) {
-            test->Run();
-            tests_run++;
-          }
-          test = test->prev();
-        }
-      }
-      free(arg_copy);
+      tests_run += RunTests(arg);
     }
   }
   if (print_run_count && tests_run != 1)
@@ -37,9 +37,8 @@ DEBUG_FLAGS = ['--enable-slow-asserts', '--debug-code', '--verify-heap']
 class CcTestCase(test.TestCase):
 
   def __init__(self, path, executable, mode, raw_name, context):
-    super(CcTestCase, self).__init__(context, path)
+    super(CcTestCase, self).__init__(context, path, mode)
     self.executable = executable
-    self.mode = mode
     self.raw_name = raw_name
 
   def GetLabel(self):
@@ -54,6 +53,17 @@ class CcTestCase(test.TestCase):
       result += DEBUG_FLAGS
     return result
 
+  def GetServerCommand(self):
+    if self.isolate:
+      return None
+    result = [ self.executable, '--fork-server' ]
+    if self.mode == 'debug':
+      result += DEBUG_FLAGS
+    return result
+
+  def GetServerRequest(self):
+    return self.raw_name
+
 
 class CcTestConfiguration(test.TestConfiguration):
 
@@ -63,24 +73,34 @@ class CcTestConfiguration(test.TestConfiguration):
   def GetBuildRequirements(self):
     return ['cctests']
 
-  def ListTests(self, current_path, path, mode):
-    executable = join('obj', 'test', mode, 'cctest')
-    if (platform.system() == 'Windows'):
-      executable += '.exe'
+  def ListRawTests(self, executable):
     output = test.Execute([executable, '--list'], self.context)
     if output.exit_code != 0:
       print output.stdout
       print output.stderr
+      return None
+    return output.stdout.strip().split()
+
+  def ListTests(self, current_path, path, mode):
+    executable = join('obj', 'test', mode, 'cctest')
+    if (platform.system() == 'Windows'):
+      executable += '.exe'
+    raw_tests = self.context.discovery.Get('cctest-list', executable,
+        lambda: self.ListRawTests(executable))
+    if raw_tests is None:
       return []
     result = []
-    for raw_test in output.stdout.strip().split():
+    for raw_test in raw_tests:
       full_path = current_path + raw_test.split('/')
       if self.Contains(path, full_path):
         result.append(CcTestCase(full_path, executable, mode, raw_test, self.context))
     return result
   
+  def GetStatusFile(self):
+    return join(self.root, 'cctest.status')
+
   def GetTestStatus(self, sections, defs):
-    status_file = join(self.root, 'cctest.status')
+    status_file = self.GetStatusFile()
     if exists(status_file):
       test.ReadConfigurationInto(status_file, sections, defs)
 
@@ -37,10 +37,9 @@ FLAGS_PATTERN = re.compile(r"//\s+Flags:(.*)")
 class MjsunitTestCase(test.TestCase):
 
   def __init__(self, path, file, mode, context, config):
-    super(MjsunitTestCase, self).__init__(context, path)
+    super(MjsunitTestCase, self).__init__(context, path, mode)
     self.file = file
     self.config = config
-    self.mode = mode
 
   def GetLabel(self):
     return "%s %s" % (self.mode, self.GetName())
@@ -48,16 +47,36 @@ class MjsunitTestCase(test.TestCase):
   def GetName(self):
     return self.path[-1]
 
+  def GetFlags(self):
+    def ReadFlags():
+      source = open(self.file).read()
+      flags_match = FLAGS_PATTERN.search(source)
+      if flags_match:
+        return flags_match.group(1).strip().split()
+      else:
+        return []
+    return self.context.discovery.Get('flags', self.file, ReadFlags)
+
+  def GetFramework(self):
+    return join(dirname(self.config.root), 'mjsunit', 'mjsunit.js')
+
   def GetCommand(self):
     result = [self.config.context.GetVm(self.mode)]
-    source = open(self.file).read()
-    flags_match = FLAGS_PATTERN.search(source)
-    if flags_match:
-      result += flags_match.group(1).strip().split()
-    framework = join(dirname(self.config.root), 'mjsunit', 'mjsunit.js')
-    result += [framework, self.file]
+    result += self.GetFlags()
+    result += [self.GetFramework(), self.file]
     return result
 
+  def GetServerCommand(self):
+    # Tests that need flags of their own, or that the status file says
+    # must be isolated, get a fresh shell.
+    if self.isolate or self.GetFlags():
+      return None
+    vm = self.config.context.GetVm(self.mode)
+    return [vm, '--fork-server', self.GetFramework()]
+
+  def GetServerRequest(self):
+    return self.file
+
   def GetSource(self):
     return open(self.file).read()
 
@@ -70,7 +89,8 @@ class MjsunitTestConfiguration(test.TestConfiguration):
   def Ls(self, path):
     def SelectTest(name):
       return name.endswith('.js') and name != 'mjsunit.js'
-    return [f[:-3] for f in os.listdir(path) if SelectTest(f)]
+    (dirs, files) = self.context.discovery.ListDir(path)
+    return [f[:-3] for f in files if SelectTest(f)]
 
   def ListTests(self, current_path, path, mode):
     mjsunit = [current_path + [t] for t in self.Ls(self.root)]
@@ -87,8 +107,11 @@ class MjsunitTestConfiguration(test.TestConfiguration):
   def GetBuildRequirements(self):
     return ['sample', 'sample=shell']
 
+  def GetStatusFile(self):
+    return join(self.root, 'mjsunit.status')
+
   def GetTestStatus(self, sections, defs):
-    status_file = join(self.root, 'mjsunit.status')
+    status_file = self.GetStatusFile()
     if exists(status_file):
       test.ReadConfigurationInto(status_file, sections, defs)
 
@@ -27,8 +27,10 @@
 
 
 import test
+import hashlib
+import json
 import os
-from os.path import join, exists
+from os.path import join, dirname, exists, isdir
 
 
 EXCLUDED = ['CVS']
@@ -57,9 +59,8 @@ TEST_DIRS = """
 class MozillaTestCase(test.TestCase):
 
   def __init__(self, filename, path, context, mode, framework):
-    super(MozillaTestCase, self).__init__(context, path)
+    super(MozillaTestCase, self).__init__(context, path, mode)
     self.filename = filename
-    self.mode = mode
     self.framework = framework
 
   def IsNegative(self):
@@ -90,27 +91,80 @@ class MozillaTestConfiguration(test.TestConfiguration):
 
   def __init__(self, context, root):
     super(MozillaTestConfiguration, self).__init__(context, root)
+    self.frameworks = { }
+    self.preludes = { }
+
+  def Walk(self, root):
+    """Like os.walk but skips dotted and excluded directories and takes
+    the directory listings from the discovery cache."""
+    if not isdir(root):
+      return
+    (dirs, files) = self.context.discovery.ListDir(root)
+    dirs = [x for x in dirs if not x.startswith('.') and not x in EXCLUDED]
+    yield (root, dirs, files)
+    for dir in dirs:
+      for entry in self.Walk(join(root, dir)):
+        yield entry
+
+  def GetFramework(self, dir):
+    """Returns the shell.js files in the given directory and the
+    directories above it up to the root of the suite, outermost
+    first."""
+    if not dir in self.frameworks:
+      if dir == self.root:
+        framework = []
+      else:
+        framework = list(self.GetFramework(dirname(dir)))
+      (dirs, files) = self.context.discovery.ListDir(dir)
+      if 'shell.js' in files:
+        framework.append(join(dir, 'shell.js'))
+      self.frameworks[dir] = framework
+    return self.frameworks[dir]
+
+  def GetPrelude(self, dir):
+    """Returns a list holding a single file with the framework of the
+    given directory inlined, or an empty list if it has none.  Each
+    shell.js is passed to eval at the top level of the prelude so it is
+    still compiled as a script of its own, as if it had been given on
+    the command line.  The file is named after a hash of its contents so
+    it is only written when the framework changes."""
+    framework = self.GetFramework(dir)
+    if not framework:
+      return []
+    key = tuple(framework)
+    if not key in self.preludes:
+      parts = [ ]
+      for file in framework:
+        # The shell reads files as UTF-8.
+        source = open(file).read().decode('utf-8', 'replace')
+        parts.append('// %s\neval(%s);\n' % (file, json.dumps(source)))
+      contents = ''.join(parts)
+      digest = hashlib.sha1(contents).hexdigest()[:16]
+      prelude_dir = join(self.context.buildspace, '.test-preludes')
+      prelude = join(prelude_dir, 'mozilla-%s.js' % digest)
+      if not exists(prelude):
+        if not isdir(prelude_dir):
+          os.makedirs(prelude_dir)
+        # Write to a temporary file first so a concurrent run never
+        # reads a partly written prelude.
+        temp = '%s.%i.tmp' % (prelude, os.getpid())
+        out = open(temp, 'w')
+        try:
+          out.write(contents)
+        finally:
+          out.close()
+        os.rename(temp, prelude)
+      self.preludes[key] = [prelude]
+    return self.preludes[key]
 
   def ListTests(self, current_path, path, mode):
     tests = []
     for test_dir in TEST_DIRS:
       current_root = join(self.root, 'data', test_dir)
-      for root, dirs, files in os.walk(current_root):
-        for dotted in [x  for x in dirs if x.startswith('.')]:
-          dirs.remove(dotted)
-        for excluded in EXCLUDED:
-          if excluded in dirs:
-            dirs.remove(excluded)
+      for root, dirs, files in self.Walk(current_root):
         root_path = root[len(self.root):].split(os.path.sep)
         root_path = current_path + [x for x in root_path if x]
-        framework = []
-        for i in xrange(len(root_path)):
-          if i == 0: dir = root_path[1:]
-          else: dir = root_path[1:-i]
-          script = join(self.root, reduce(join, dir, ''), 'shell.js')
-          if exists(script):
-            framework.append(script)
-        framework.reverse()
+        framework = self.GetPrelude(root)
         for file in files:
           if (not file in FRAMEWORK) and file.endswith('.js'):
             full_path = root_path + [file[:-3]]
@@ -124,8 +178,11 @@ class MozillaTestConfiguration(test.TestConfiguration):
   def GetBuildRequirements(self):
     return ['sample', 'sample=shell']
 
+  def GetStatusFile(self):
+    return join(self.root, 'mozilla.status')
+
   def GetTestStatus(self, sections, defs):
-    status_file = join(self.root, 'mozilla.status')
+    status_file = self.GetStatusFile()
     if exists(status_file):
       test.ReadConfigurationInto(status_file, sections, defs)
 
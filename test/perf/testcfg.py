@@ -0,0 +1,220 @@
+# Copyright 2008 the V8 project authors. All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#     * Neither the name of Google Inc. nor the names of its
+#       contributors may be used to endorse or promote products derived
+#       from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import test
+import json
+import math
+import platform
+import re
+import threading
+from os.path import join, dirname, exists
+
+
+# The number of times each benchmark is run.  The scores of the runs are
+# compared with those of the baseline.
+RUNS = 5
+
+# A benchmark fails if its mean score is more than this fraction below
+# the baseline and the difference is statistically significant.
+THRESHOLD = 0.03
+
+# Two-sided critical values of Student's t distribution at the 95%
+# level, by degrees of freedom.
+T_CRITICAL = [
+  (1, 12.71), (2, 4.30), (3, 3.18), (4, 2.78), (5, 2.57), (6, 2.45),
+  (7, 2.36), (8, 2.31), (9, 2.26), (10, 2.23), (15, 2.13), (20, 2.09),
+  (30, 2.04)
+]
+
+SCORE_PATTERN = re.compile(r'^Score: (\d+)$', re.MULTILINE)
+
+
+def GetCriticalValue(df):
+  for (degrees, value) in T_CRITICAL:
+    if df <= degrees:
+      return value
+  return 1.96
+
+
+def GetMeanAndVariance(samples):
+  mean = float(sum(samples)) / len(samples)
+  if len(samples) < 2:
+    return (mean, 0.0)
+  variance = sum([(x - mean) ** 2 for x in samples]) / (len(samples) - 1)
+  return (mean, variance)
+
+
+def IsSignificantlySlower(baseline, scores):
+  """Compares the scores with those of the baseline using Welch's t
+  test.  Higher scores are better."""
+  (baseline_mean, baseline_variance) = GetMeanAndVariance(baseline)
+  (mean, variance) = GetMeanAndVariance(scores)
+  if mean >= baseline_mean * (1 - THRESHOLD):
+    return False
+  a = baseline_variance / len(baseline)
+  b = variance / len(scores)
+  if a + b == 0:
+    return True
+  t = (baseline_mean - mean) / math.sqrt(a + b)
+  # The Welch-Satterthwaite approximation of the degrees of freedom.
+  df = (a + b) ** 2 / ((a ** 2 / max(len(baseline) - 1, 1))
+                       + (b ** 2 / max(len(scores) - 1, 1)))
+  return t > GetCriticalValue(df)
+
+
+class PerfBaseline(object):
+  """The benchmark scores that later runs are compared against, kept in
+  a file for each machine.  The first scores of a benchmark in a mode
+  become its baseline; remove them from the file to record new ones."""
+
+  def __init__(self, path):
+    self.path = path
+    self.machine = platform.node()
+    self.scores = { }
+    self.lock = threading.Lock()
+    if exists(path):
+      try:
+        self.scores = json.load(open(path)).get(self.machine, { })
+      except (IOError, ValueError), e:
+        test.PrintError("Ignoring unreadable perf baseline %s: %s" % (path, e))
+
+  def Get(self, key):
+    self.lock.acquire()
+    try:
+      return self.scores.get(key)
+    finally:
+      self.lock.release()
+
+  def Set(self, key, scores):
+    self.lock.acquire()
+    try:
+      self.scores[key] = scores
+      # Other machines may share the file.
+      contents = { }
+      if exists(self.path):
+        try:
+          contents = json.load(open(self.path))
+        except ValueError:
+          pass
+      contents[self.machine] = self.scores
+      out = open(self.path, 'w')
+      try:
+        json.dump(contents, out)
+      finally:
+        out.close()
+    finally:
+      self.lock.release()
+
+
+class PerfTestCase(test.TestCase):
+
+  def __init__(self, path, file, mode, context, config):
+    super(PerfTestCase, self).__init__(context, path, mode)
+    self.file = file
+    self.config = config
+
+  def GetLabel(self):
+    return "%s perf %s" % (self.mode, self.GetName())
+
+  def GetName(self):
+    return self.path[-1]
+
+  def GetCommand(self):
+    benchmarks = self.config.GetBenchmarksRoot()
+    return [self.context.GetVm(self.mode), join(benchmarks, 'base.js'),
+            self.file, join(self.config.root, 'harness.js')]
+
+  def IsCacheable(self):
+    return False
+
+  def Execute(self, command):
+    scores = [ ]
+    stdout = [ ]
+    for i in xrange(RUNS):
+      output = super(PerfTestCase, self).Execute(command)
+      match = SCORE_PATTERN.search(output.stdout)
+      if output.exit_code != 0 or output.timed_out or not match:
+        return output
+      scores.append(int(match.group(1)))
+      stdout.append(output.stdout.strip())
+    key = "%s/%s" % ("/".join(self.path), self.mode)
+    baseline = self.config.baseline.Get(key)
+    if not baseline:
+      self.config.baseline.Set(key, scores)
+      baseline = scores
+    stdout.append("Scores: %s" % " ".join([str(s) for s in scores]))
+    stdout.append("Baseline: %s" % " ".join([str(s) for s in baseline]))
+    exit_code = 0
+    if IsSignificantlySlower(baseline, scores):
+      stdout.append("Slower than the baseline")
+      exit_code = 1
+    return test.CommandOutput(exit_code, "\n".join(stdout), "")
+
+  def GetSource(self):
+    return open(self.file).read()
+
+
+class PerfTestConfiguration(test.TestConfiguration):
+
+  def __init__(self, context, root):
+    super(PerfTestConfiguration, self).__init__(context, root)
+    self.baseline = PerfBaseline(join(context.buildspace, '.perf-baseline'))
+
+  def GetBenchmarksRoot(self):
+    return join(dirname(dirname(self.root)), 'benchmarks')
+
+  def Ls(self, path):
+    def SelectBenchmark(name):
+      return name.endswith('.js') and not name in ['base.js', 'run.js']
+    (dirs, files) = self.context.discovery.ListDir(path)
+    return [f[:-3] for f in files if SelectBenchmark(f)]
+
+  def ListTests(self, current_path, path, mode):
+    benchmarks = self.GetBenchmarksRoot()
+    result = []
+    for name in self.Ls(benchmarks):
+      test = current_path + [name]
+      if self.Contains(path, test):
+        file_path = join(benchmarks, name + '.js')
+        result.append(PerfTestCase(test, file_path, mode, self.context, self))
+    return result
+
+  def GetBuildRequirements(self):
+    return ['sample', 'sample=shell']
+
+  def GetStatusFile(self):
+    return join(self.root, 'perf.status')
+
+  def GetTestStatus(self, sections, defs):
+    status_file = self.GetStatusFile()
+    if exists(status_file):
+      test.ReadConfigurationInto(status_file, sections, defs)
+
+
+def GetConfiguration(context, root):
+  return PerfTestConfiguration(context, root)
@@ -28,36 +28,128 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 # Usage: process-ticks.py <logfile>
-# Where <logfile> is the log file name (eg, v8.log).
+# Where <logfile> is the log file name (eg, v8.log).  Logs compressed
+# with gzip or xz are read if their names end in .gz or .xz and '-'
+# reads the log from stdin.
 
 import os, re, sys, tickprocessor, getopt;
+import hashlib, json, multiprocessing, subprocess
 
-class LinuxTickProcessor(tickprocessor.TickProcessor):
+# Symbols read from binaries are kept here, keyed by the path, size,
+# modification time and build id of the binary.
+SYMBOL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.v8-symbol-cache')
 
-  def ParseVMSymbols(self, filename, start, end):
-    """Extract symbols and add them to the cpp entries."""
-    pipe = os.popen('nm -n %s | c++filt' % filename, 'r')
+
+def GetBuildId(filename):
+  try:
+    process = subprocess.Popen(['readelf', '-n', filename],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  except OSError:
+    return ''
+  output = process.communicate()[0]
+  match = re.search('Build ID: ([0-9a-fA-F]+)', output)
+  if match:
+    return match.group(1)
+  return ''
+
+
+def ReadSymbols(filename):
+  """Returns the symbols of a binary as a list of (address, name) pairs."""
+  symbols = []
+  pipe = os.popen('nm -n %s | c++filt' % filename, 'r')
+  try:
+    for line in pipe:
+      row = re.match('^([0-9a-fA-F]{8}) . (.*)$', line)
+      if row:
+        symbols.append((int(row.group(1), 16), row.group(2)))
+  finally:
+    pipe.close()
+  return symbols
+
+
+def LoadSymbols(filename):
+  """Returns the symbols of a binary, from the symbol cache if they have
+  been read before.  Runs in a worker process."""
+  try:
+    stat = os.stat(filename)
+  except OSError:
+    return ReadSymbols(filename)
+  key = '%s:%d:%r:%s' % (os.path.abspath(filename), stat.st_size,
+                         stat.st_mtime, GetBuildId(filename))
+  cache_file = os.path.join(SYMBOL_CACHE_DIR, hashlib.sha1(key).hexdigest())
+  try:
+    return [(addr, name.encode('utf-8'))
+            for (addr, name) in json.load(open(cache_file))]
+  except (IOError, ValueError):
+    pass
+  symbols = ReadSymbols(filename)
+  # The cache is only an optimization so failing to write it is fine.
+  try:
+    if not os.path.isdir(SYMBOL_CACHE_DIR):
+      os.makedirs(SYMBOL_CACHE_DIR)
+    temp = '%s.%d.tmp' % (cache_file, os.getpid())
+    out = open(temp, 'w')
     try:
-      for line in pipe:
-        row = re.match('^([0-9a-fA-F]{8}) . (.*)$', line)
-        if row:
-          addr = int(row.group(1), 16)
-          if addr < start and addr < end - start:
-            addr += start
-          self.cpp_entries.Insert(addr, tickprocessor.CodeEntry(addr, row.group(2)))
+      json.dump(symbols, out)
     finally:
-      pipe.close()
+      out.close()
+    os.rename(temp, cache_file)
+  except (IOError, OSError):
+    pass
+  return symbols
+
+
+class LinuxTickProcessor(tickprocessor.TickProcessor):
+
+  def __init__(self):
+    super(LinuxTickProcessor, self).__init__()
+    self.pool = None
+    self.pending_symbols = []
+
+  def ParseVMSymbols(self, filename, start, end):
+    """Starts extracting the symbols of a library in a worker process.
+    They are added to the cpp entries when they are first needed."""
+    if multiprocessing.current_process().daemon:
+      # The workers of a pool can't have pools of their own.
+      self.AddVMSymbols(LoadSymbols(filename), start, end)
+      return
+    if not self.pool:
+      self.pool = multiprocessing.Pool()
+    result = self.pool.apply_async(LoadSymbols, [filename])
+    self.pending_symbols.append((result, start, end))
+
+  def WaitForVMSymbols(self):
+    for (result, start, end) in self.pending_symbols:
+      self.AddVMSymbols(result.get(), start, end)
+    self.pending_symbols = []
+    if self.pool:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+
+  def AddVMSymbols(self, symbols, start, end):
+    """Add symbols to the cpp entries."""
+    for (addr, name) in symbols:
+      if addr < start and addr < end - start:
+        addr += start
+      self.cpp_entries.Insert(addr, tickprocessor.CodeEntry(addr, name))
 
 
 def Usage():
-  print("Usage: linux-tick-processor.py --{js,gc,compiler,other}  logfile-name");
+  print("Usage: linux-tick-processor.py --{js,gc,compiler,other} [--parallel] [--window=ms] [--timeline=csv-file] [--pprof=file] [--callgrind=file] [--folded=file] logfile-name|-");
+  print("       linux-tick-processor.py --{js,gc,compiler,other} [--parallel] --diff old-logfile-name new-logfile-name");
   sys.exit(2)
 
 def Main():
   # parse command line options
   state = None;
+  parallel = False
+  time_window = None
+  timeline_file = None
+  diff = False
+  exports = []
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "jgco", ["js", "gc", "compiler", "other"])
+    opts, args = getopt.getopt(sys.argv[1:], "jgcop", ["js", "gc", "compiler", "other", "parallel", "window=", "timeline=", "diff", "pprof=", "callgrind=", "folded="])
   except getopt.GetoptError:
     usage()
   # process options.
@@ -70,12 +162,44 @@ def Main():
       state = 2
     if key in ("-o", "--other"):
       state = 3
+    if key in ("-p", "--parallel"):
+      parallel = True
+    if key == "--window":
+      try:
+        time_window = int(value)
+      except ValueError:
+        Usage()
+      if time_window <= 0:
+        Usage()
+    if key == "--timeline":
+      timeline_file = value
+    if key == "--diff":
+      diff = True
+    if key in ("--pprof", "--callgrind", "--folded"):
+      exports.append((key, value))
+  if timeline_file is not None and time_window is None:
+    time_window = 1000
   # do the processing.
+  def ProcessLog(filename):
+    tick_processor = LinuxTickProcessor()
+    if time_window is not None and not diff:
+      tick_processor.SetTimeWindow(time_window, timeline_file)
+    if parallel:
+      tick_processor.ProcessLogfileInParallel(filename, state)
+    else:
+      tick_processor.ProcessLogfile(filename, state)
+    return tick_processor
+  if diff:
+    if len(args) != 2:
+      Usage();
+    tickprocessor.PrintProfileDiff(ProcessLog(args[0]), ProcessLog(args[1]))
+    return
   if len(args) != 1:
       Usage();
-  tick_processor = LinuxTickProcessor()
-  tick_processor.ProcessLogfile(args[0], state)
+  tick_processor = ProcessLog(args[0])
   tick_processor.PrintResults()
+  for (key, value) in exports:
+    tick_processor.ExportProfile(key[2:], value)
 
 if __name__ == '__main__':
   Main()
@@ -26,6 +26,11 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+class KeyNotFound(Exception):
+  """Raised when removing a key that is not in the tree."""
+  pass
+
+
 class Node(object):
   """Nodes in the splay tree."""
 
@@ -75,12 +80,12 @@ class SplayTree(object):
     """Remove the node with the given key from the SplayTree."""
     # Raise exception for key that is not found if the tree is empty.
     if self.IsEmpty():
-      raise 'KeyNotFound'
+      raise KeyNotFound(key)
     # Splay on the key to move the node with the given key to the top.
     self.Splay(key)
     # Raise exception for key that is not found.
     if self.root.key != key:
-      raise 'KeyNotFound'
+      raise KeyNotFound(key)
     removed = self.root
     # Link out the root node.
     if not self.root.left:
@@ -27,16 +27,22 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import errno
+import hashlib
+import heapq
 import imp
+import json
+import multiprocessing
 import optparse
 import os
-from os.path import join, dirname, abspath, basename
+from os.path import join, dirname, abspath, basename, exists
 import platform
 import re
+import select
 import signal
 import subprocess
 import sys
-import tempfile
+import threading
 import time
 import utils
 
@@ -49,32 +55,278 @@ VERBOSE = False
 # ---------------------------------------------
 
 
+class TestScheduler(object):
+  """Hands out the tests to run to the worker threads.  More tests can
+  be added while the workers are running so a worker that finds no test
+  waits until more are added or the scheduler is closed."""
+
+  # The number of tests that may be started ahead of the next test in
+  # line while it does not fit.  After that no test is started until it
+  # fits, so it cannot be starved by smaller tests behind it.
+  MAX_BYPASSES = 8
+
+  def __init__(self, cases):
+    self.pending = list(cases)
+    self.running = [ ]
+    self.closed = False
+    # The number of tests started ahead of the first pending one.
+    self.bypasses = 0
+    # The number of tests that may run at the same time, counting tests
+    # that use several CPUs several times.
+    self.slots = 1
+    # If set, the sum of the estimated peak memory use of the running
+    # tests in megabytes is kept under this, unless a single test needs
+    # more.
+    self.memory_budget = None
+    self.estimate_memory = None
+    self.condition = threading.Condition()
+
+  def SetMemoryBudget(self, budget, estimate_memory):
+    self.memory_budget = budget
+    self.estimate_memory = estimate_memory
+
+  def Fits(self, test):
+    if not self.running:
+      return True
+    if test.case.exclusive:
+      return False
+    for other in self.running:
+      if other.case.exclusive:
+        return False
+    cpus = test.case.cpus
+    for other in self.running:
+      cpus += other.case.cpus
+    if cpus > self.slots:
+      return False
+    if self.memory_budget:
+      memory = self.estimate_memory(test.case)
+      for other in self.running:
+        memory += self.estimate_memory(other.case)
+      if memory > self.memory_budget:
+        return False
+    return True
+
+  def Add(self, cases):
+    self.condition.acquire()
+    try:
+      self.pending += cases
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+  def Close(self):
+    self.condition.acquire()
+    try:
+      self.closed = True
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+  def Abort(self):
+    self.condition.acquire()
+    try:
+      self.pending = [ ]
+      self.closed = True
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+  def Get(self):
+    """Returns the next test to run or None if there are no more.  Tests
+    are handed out in order.  If the next one does not fit next to the
+    tests that are already running a later one that fits is started
+    instead, up to MAX_BYPASSES times."""
+    self.condition.acquire()
+    try:
+      while True:
+        if not self.pending and self.closed:
+          return None
+        index = None
+        if self.pending and self.Fits(self.pending[0]):
+          index = 0
+          self.bypasses = 0
+        elif self.bypasses < self.MAX_BYPASSES:
+          for i in xrange(1, len(self.pending)):
+            if self.Fits(self.pending[i]):
+              index = i
+              self.bypasses += 1
+              break
+        if index is not None:
+          test = self.pending.pop(index)
+          self.running.append(test)
+          return test
+        # Wait with a timeout so that signals (ctrl-c) are still
+        # delivered when this is the main thread.
+        self.condition.wait(1)
+    finally:
+      self.condition.release()
+
+  def Release(self, test):
+    """Called when a test returned by Get has finished."""
+    self.condition.acquire()
+    try:
+      self.running.remove(test)
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+
 class ProgressIndicator(object):
 
   def __init__(self, cases):
     self.cases = cases
+    self.scheduler = TestScheduler(cases)
     self.succeeded = 0
     self.failed = 0
     self.remaining = len(self.cases)
     self.total = len(self.cases)
     self.failed_tests = [ ]
+    self.outputs = [ ]
+    self.records = None
+    self.terminate = False
+    self.parallel = False
+    self.feed_error = None
+    self.worker_error = None
+    self.lock = threading.Lock()
+
+  def AddCases(self, cases):
+    self.lock.acquire()
+    try:
+      self.total += len(cases)
+      self.remaining += len(cases)
+      self.Adding(cases)
+    finally:
+      self.lock.release()
+    self.scheduler.Add(cases)
 
-  def Run(self):
+  def Feed(self, feeder):
+    try:
+      try:
+        for cases in feeder:
+          if self.terminate:
+            break
+          self.AddCases(cases)
+      except:
+        self.feed_error = sys.exc_info()
+    finally:
+      self.scheduler.Close()
+
+  def Run(self, tasks, feeder=None):
+    """Runs the tests, using the given number of threads.  If a feeder
+    is given the tests it produces, a list at a time, are run as well as
+    soon as they are available."""
+    self.parallel = tasks > 1
+    self.scheduler.slots = tasks
     self.Starting()
-    for test in self.cases:
-      case = test.case
-      self.AboutToRun(case)
-      output = case.Run()
-      if output.UnexpectedOutput():
-        self.failed += 1
-        self.failed_tests.append(output)
-      else:
-        self.succeeded += 1
-      self.remaining -= 1
-      self.HasRun(output)
+    threads = [ ]
+    if feeder:
+      thread = threading.Thread(target=self.Feed, args=[feeder])
+      thread.daemon = True
+      threads.append(thread)
+      thread.start()
+    else:
+      self.scheduler.Close()
+    # Spawn N-1 threads and then use this thread as the last one.
+    # That way -j1 runs the tests serially on the main thread, in the
+    # same order as before.
+    for i in xrange(tasks - 1):
+      thread = threading.Thread(target=self.RunWorker, args=[])
+      threads.append(thread)
+      thread.start()
+    try:
+      self.RunSingle()
+      # Wait for the remaining threads.  Use a timeout so that signals
+      # (ctrl-c) are still delivered to the main thread.
+      for thread in threads:
+        while thread.isAlive():
+          thread.join(timeout=10000000)
+    except:
+      # If something goes wrong tell the remaining threads to stop
+      # picking up new tests and then reraise the exception.
+      self.terminate = True
+      self.scheduler.Abort()
+      raise
+    if self.worker_error:
+      raise self.worker_error[0], self.worker_error[1], self.worker_error[2]
+    if self.feed_error:
+      raise self.feed_error[0], self.feed_error[1], self.feed_error[2]
     self.Done()
     return self.failed == 0
 
+  def RunWorker(self):
+    # An exception would only end this thread, leaving its test uncounted,
+    # so stop the run and have Run reraise it.
+    try:
+      self.RunSingle()
+    except:
+      self.lock.acquire()
+      try:
+        if self.worker_error is None:
+          self.worker_error = sys.exc_info()
+      finally:
+        self.lock.release()
+      self.terminate = True
+      self.scheduler.Abort()
+
+  def RunSingle(self):
+    while not self.terminate:
+      test = self.scheduler.Get()
+      if test is None:
+        return
+      case = test.case
+      self.lock.acquire()
+      try:
+        self.AboutToRun(case)
+      finally:
+        self.lock.release()
+      start = time.time()
+      try:
+        output = case.Run()
+      finally:
+        self.scheduler.Release(test)
+      if not output.cached:
+        output.duration = case.duration = time.time() - start
+      if self.terminate:
+        return
+      self.lock.acquire()
+      try:
+        if output.UnexpectedOutput():
+          self.failed += 1
+          self.failed_tests.append(output)
+        else:
+          self.succeeded += 1
+        self.outputs.append(output)
+        if self.records:
+          WriteRecord(self.records, output)
+        self.remaining -= 1
+        self.HasRun(output)
+      finally:
+        self.lock.release()
+
+
+def WriteRecord(file, output):
+  """Writes a line of JSON describing the outcome of a test and the
+  resources it used."""
+  case = output.test
+  record = {
+    'path': "/".join(case.path),
+    'mode': case.mode,
+    'unexpected': bool(output.UnexpectedOutput()),
+    'failed': bool(output.HasFailed()),
+    'exit_code': output.output.exit_code,
+    'timed_out': output.output.timed_out,
+    'cached': output.cached,
+    'time': time.time()
+  }
+  usage = output.output.usage
+  if usage:
+    record['wall_time'] = round(usage.wall_time, 6)
+    record['user_time'] = usage.user_time
+    record['system_time'] = usage.system_time
+    record['max_rss'] = usage.max_rss
+  file.write(json.dumps(record, sort_keys=True) + '\n')
+  file.flush()
+
 
 def EscapeCommand(command):
   parts = []
@@ -93,6 +345,9 @@ class SimpleProgressIndicator(ProgressIndicator):
   def Starting(self):
     print 'Running %i tests' % len(self.cases)
 
+  def Adding(self, cases):
+    print 'Running %i more tests' % len(cases)
+
   def Done(self):
     print
     for failed in self.failed_tests:
@@ -103,6 +358,8 @@ class SimpleProgressIndicator(ProgressIndicator):
       if failed.output.stdout:
         print "--- stdout ---"
         print failed.output.stdout.strip()
+      if failed.output.timed_out:
+        print "--- TIMEOUT ---"
       print "Command: %s" % EscapeCommand(failed.command)
     if len(self.failed_tests) == 0:
       print "==="
@@ -117,11 +374,32 @@ class SimpleProgressIndicator(ProgressIndicator):
 
 class VerboseProgressIndicator(SimpleProgressIndicator):
 
+  def __init__(self, cases):
+    super(VerboseProgressIndicator, self).__init__(cases)
+    # The label printed for the running test when not running in
+    # parallel, while it waits for the result on the same line.
+    self.running_label = None
+
+  def Adding(self, cases):
+    if self.running_label:
+      print
+    super(VerboseProgressIndicator, self).Adding(cases)
+    if self.running_label:
+      print self.running_label,
+      sys.stdout.flush()
+
   def AboutToRun(self, case):
-    print '%s:' % case.GetLabel(),
-    sys.stdout.flush()
+    # When running in parallel other tests may finish before this one
+    # so the label is printed together with the result instead.
+    if not self.parallel:
+      self.running_label = '%s:' % case.GetLabel()
+      print self.running_label,
+      sys.stdout.flush()
 
   def HasRun(self, output):
+    self.running_label = None
+    if self.parallel:
+      print '%s:' % output.test.GetLabel(),
     if output.UnexpectedOutput():
       print "FAIL"
     else:
@@ -133,6 +411,11 @@ class DotsProgressIndicator(SimpleProgressIndicator):
   def AboutToRun(self, case):
     pass
 
+  def Adding(self, cases):
+    if self.succeeded + self.failed > 0:
+      sys.stdout.write('\n')
+    super(DotsProgressIndicator, self).Adding(cases)
+
   def HasRun(self, output):
     total = self.succeeded + self.failed
     if (total > 1) and (total % 50 == 1):
@@ -156,6 +439,9 @@ class CompactProgressIndicator(ProgressIndicator):
   def Starting(self):
     pass
 
+  def Adding(self, cases):
+    pass
+
   def Done(self):
     self.PrintProgress('Done')
 
@@ -172,6 +458,8 @@ class CompactProgressIndicator(ProgressIndicator):
       stderr = output.output.stderr.strip()
       if len(stderr):
         print self.templates['stderr'] % stderr
+      if output.output.timed_out:
+        print "--- TIMEOUT ---"
 
   def Truncate(self, str, length):
     if length and (len(str) > (length - 3)):
@@ -184,7 +472,7 @@ class CompactProgressIndicator(ProgressIndicator):
     elapsed = time.time() - self.start_time
     status = self.templates['status_line'] % {
       'passed': self.succeeded,
-      'remaining': (((self.total - self.remaining) * 100) // self.total),
+      'remaining': (((self.total - self.remaining) * 100) // max(self.total, 1)),
       'failed': self.failed,
       'test': name,
       'mins': int(elapsed) / 60,
@@ -241,17 +529,53 @@ PROGRESS_INDICATORS = {
 
 class CommandOutput(object):
 
-  def __init__(self, exit_code, stdout, stderr):
+  def __init__(self, exit_code, stdout, stderr, timed_out=False, usage=None):
     self.exit_code = exit_code
     self.stdout = stdout
     self.stderr = stderr
+    self.timed_out = timed_out
+    self.usage = usage
+
+
+class ResourceUsage(object):
+  """The wall clock time, CPU time (in seconds) and peak resident set
+  size (in kilobytes) of a process.  Everything but the wall clock time
+  is None where the platform doesn't tell us."""
+
+  def __init__(self, wall_time, user_time=None, system_time=None,
+               max_rss=None):
+    self.wall_time = wall_time
+    self.user_time = user_time
+    self.system_time = system_time
+    self.max_rss = max_rss
+
+
+def NormalizeMaxRss(max_rss):
+  # Mac OS reports the peak resident set size in bytes, everybody else
+  # in kilobytes.
+  if platform.system() == 'Darwin':
+    return max_rss // 1024
+  else:
+    return max_rss
 
 
 class TestCase(object):
 
-  def __init__(self, context, path):
+  def __init__(self, context, path, mode):
     self.path = path
     self.context = context
+    self.mode = mode
+    self.duration = None
+    # The peak memory use in megabytes and the number of CPUs the test
+    # is declared to use in the status file.
+    self.memory = None
+    self.cpus = 1
+    # Whether the status file says the test must not share a process
+    # with other tests.
+    self.isolate = False
+    # Whether the status file says nothing else may run at the same
+    # time as the test.
+    self.exclusive = False
 
   def IsNegative(self):
     return False
@@ -262,19 +586,71 @@ class TestCase(object):
   def GetSource(self):
     return "(no source available)"
 
+  def GetServerCommand(self):
+    """Returns the command that starts a fork server able to run this
+    test, or None if the test has to be run in a process of its own.
+    Tests that return the same command share servers."""
+    return None
+
+  def GetServerRequest(self):
+    """Returns the line sent to the fork server to run this test."""
+    return None
+
+  def IsCacheable(self):
+    """Returns whether the output of this test is determined by its
+    command, so a cached output can stand in for running it."""
+    return True
+
+  def Execute(self, command):
+    servers = self.context.servers
+    if servers:
+      server_command = self.GetServerCommand()
+      if server_command:
+        output = servers.Run(server_command, self.GetServerRequest(),
+                             self.context.GetTimeout(self))
+        if output:
+          return output
+    return Execute(command, self.context, self.context.GetTimeout(self))
+
+  def GetProfileLog(self):
+    """Returns the file the profiler log of this test is written to
+    when profiling."""
+    name = "%s.%s.log" % (".".join(self.path), self.mode)
+    return join(self.context.profile_dir, name)
+
   def Run(self):
     command = self.GetCommand()
+    if self.context.profile_dir:
+      log = self.GetProfileLog()
+      if exists(log):
+        os.unlink(log)
+      command = command + ['--prof', '--logfile=' + log]
     full_command = self.context.processor(command)
-    output = Execute(full_command, self.context, self.context.timeout)
-    return TestOutput(self, full_command, output)
+    cache = self.context.cache
+    if not self.IsCacheable():
+      cache = None
+    if cache:
+      key = cache.GetKey(self, full_command)
+      output = cache.Lookup(key)
+      if output:
+        return TestOutput(self, full_command, output, True)
+    output = self.Execute(full_command)
+    result = TestOutput(self, full_command, output)
+    # Only outputs that were as expected are kept; flaky failures and
+    # timeouts tell us nothing certain about the next run.
+    if cache and not output.timed_out and not result.UnexpectedOutput():
+      cache.Store(key, output)
+    return result
 
 
 class TestOutput(object):
 
-  def __init__(self, test, command, output):
+  def __init__(self, test, command, output, cached=False):
     self.test = test
     self.command = command
     self.output = output
+    self.cached = cached
+    self.duration = None
 
   def UnexpectedOutput(self):
     if self.HasFailed():
@@ -295,46 +671,136 @@ def KillProcessWithID(pid):
   if platform.system() == 'Windows':
     os.popen('taskkill /T /F /PID %d' % pid)
   else:
-    os.kill(pid, signal.SIGTERM)
+    # Every child is the leader of its own process group so killing the
+    # group also takes down anything the test has spawned.
+    try:
+      os.killpg(pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+
+# The ids of all processes we are currently waiting for, so they can be
+# killed if the test run is interrupted.
+RUNNING_PIDS = set()
+RUNNING_PIDS_LOCK = threading.Lock()
+
+
+def KillRunningProcesses():
+  RUNNING_PIDS_LOCK.acquire()
+  try:
+    for pid in RUNNING_PIDS:
+      KillProcessWithID(pid)
+  finally:
+    RUNNING_PIDS_LOCK.release()
+
+
+def DecodeExitStatus(status):
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  else:
+    return os.WEXITSTATUS(status)
 
 
-MAX_SLEEP_TIME = 0.1
-INITIAL_SLEEP_TIME = 0.0001
-SLEEP_TIME_FACTOR = 1.25
+def ReadPipes(pipes):
+  """Reads the given pipes until they have all been closed, blocking in
+  select until there is more data."""
+  chunks = dict([(pipe, [ ]) for pipe in pipes])
+  open_pipes = list(pipes)
+  while open_pipes:
+    try:
+      (readable, writable, failed) = select.select(open_pipes, [ ], [ ])
+    except select.error, e:
+      if e[0] == errno.EINTR:
+        continue
+      raise
+    for pipe in readable:
+      data = os.read(pipe.fileno(), 65536)
+      if data:
+        chunks[pipe].append(data)
+      else:
+        open_pipes.remove(pipe)
+        pipe.close()
+  return [ "".join(chunks[pipe]) for pipe in pipes ]
 
 
-def RunProcess(context, timeout, args, **rest):
+def WaitForProcess(process):
+  """Collects the output of a process and reaps it as soon as it exits.
+  Returns a (exit_code, stdout, stderr, rusage) tuple, where rusage is
+  None if the platform can't tell the resource usage of a child."""
+  if platform.system() == 'Windows':
+    (stdout, stderr) = process.communicate()
+    return (process.returncode, stdout or "", stderr or "", None)
+  pipes = [ p for p in [process.stdout, process.stderr] if p ]
+  output = dict(zip(pipes, ReadPipes(pipes)))
+  while True:
+    try:
+      (pid, status, rusage) = os.wait4(process.pid, 0)
+      break
+    except OSError, e:
+      if e.errno != errno.EINTR:
+        raise
+  process.returncode = DecodeExitStatus(status)
+  return (process.returncode,
+          output.get(process.stdout, ""),
+          output.get(process.stderr, ""),
+          rusage)
+
+
+def RunProcess(context, timeout, args, capture=False):
   if context.verbose: print "#", " ".join(args)
   popen_args = args
   if platform.system() == 'Windows':
     popen_args = '"' + subprocess.list2cmdline(args) + '"'
+    preexec_fn = None
+  else:
+    preexec_fn = os.setpgrp
+  if capture:
+    pipe = subprocess.PIPE
+  else:
+    pipe = None
+  start = time.time()
   process = subprocess.Popen(
     shell = (platform.system() == 'Windows'),
     args = popen_args,
-    **rest
+    stdout = pipe,
+    stderr = pipe,
+    preexec_fn = preexec_fn,
+    # Tests are started from several threads at once; without this a
+    # test could inherit the pipes of another and keep them open,
+    # delaying the end of that test until it exits.
+    close_fds = (platform.system() != 'Windows')
   )
-  # Compute the end time - if the process crosses this limit we
-  # consider it timed out.
-  if timeout is None: end_time = None
-  else: end_time = time.time() + timeout
-  timed_out = False
-  # Repeatedly check the exit code from the process in a
-  # loop and keep track of whether or not it times out.
-  exit_code = None
-  sleep_time = INITIAL_SLEEP_TIME
-  while exit_code is None:
-    if (not end_time is None) and (time.time() >= end_time):
-      # Kill the process and wait for it to exit.
+  RUNNING_PIDS_LOCK.acquire()
+  RUNNING_PIDS.add(process.pid)
+  RUNNING_PIDS_LOCK.release()
+  # Rather than polling the process we block until it exits and let a
+  # watchdog kill it if it crosses the time limit.
+  timed_out = [ False ]
+  def OnTimeout():
+    timed_out[0] = True
+    KillProcessWithID(process.pid)
+  watchdog = None
+  if timeout is not None:
+    watchdog = threading.Timer(timeout, OnTimeout)
+    watchdog.start()
+  try:
+    try:
+      (exit_code, stdout, stderr, rusage) = WaitForProcess(process)
+    except:
       KillProcessWithID(process.pid)
-      exit_code = process.wait()
-      timed_out = True
-    else:
-      exit_code = process.poll()
-      time.sleep(sleep_time)
-      sleep_time = sleep_time * SLEEP_TIME_FACTOR
-      if sleep_time > MAX_SLEEP_TIME:
-        sleep_time = MAX_SLEEP_TIME
-  return (process, exit_code, timed_out)
+      raise
+  finally:
+    if watchdog:
+      watchdog.cancel()
+    RUNNING_PIDS_LOCK.acquire()
+    RUNNING_PIDS.discard(process.pid)
+    RUNNING_PIDS_LOCK.release()
+  usage = ResourceUsage(time.time() - start)
+  if rusage:
+    usage.user_time = rusage.ru_utime
+    usage.system_time = rusage.ru_stime
+    usage.max_rss = NormalizeMaxRss(rusage.ru_maxrss)
+  return CommandOutput(exit_code, stdout, stderr, timed_out[0], usage)
 
 
 def PrintError(str):
@@ -343,36 +809,155 @@ def PrintError(str):
 
 
 def Execute(args, context, timeout=None):
-  (fd_out, outname) = tempfile.mkstemp()
-  (fd_err, errname) = tempfile.mkstemp()
-  (process, exit_code, timed_out) = RunProcess(
-    context,
-    timeout,
-    args = args,
-    stdout = fd_out,
-    stderr = fd_err,
-  )
-  os.close(fd_out)
-  os.close(fd_err)
-  output = file(outname).read()
-  errors = file(errname).read()
-  def CheckedUnlink(name):
-    try:
-      os.unlink(name)
-    except OSError, e:
-      PrintError(str(e))
-  CheckedUnlink(outname)
-  CheckedUnlink(errname)
-  return CommandOutput(exit_code, output, errors)
+  return RunProcess(context, timeout, args, capture=True)
 
 
 def ExecuteNoCapture(args, context, timeout=None):
-  (process, exit_code, timed_out) = RunProcess(
-    context,
-    timeout,
-    args = args,
-  )
-  return CommandOutput(exit_code, "", "")
+  output = RunProcess(context, timeout, args)
+  return CommandOutput(output.exit_code, "", "", output.timed_out)
+
+
+class ForkServer(object):
+  """A process that runs tests on request, forking a child for each so
+  only the child is lost if a test crashes.  Requests are single lines
+  on the server's stdin.  For each the server replies with the pid of
+  the child, any number of 'out <n>' and 'err <n>' records each followed
+  by n bytes of output, and finally 'status <exit code> <user time>
+  <system time> <peak rss>' with the CPU times in seconds and the peak
+  resident set size as reported by the system."""
+
+  def __init__(self, context, command):
+    if context.verbose: print "#", " ".join(command)
+    self.process = subprocess.Popen(
+      args = command,
+      bufsize = -1,
+      stdin = subprocess.PIPE,
+      stdout = subprocess.PIPE,
+      preexec_fn = os.setpgrp,
+      close_fds = True
+    )
+    RUNNING_PIDS_LOCK.acquire()
+    RUNNING_PIDS.add(self.process.pid)
+    RUNNING_PIDS_LOCK.release()
+
+  def ReadRecord(self):
+    parts = self.process.stdout.readline().split()
+    if len(parts) < 2:
+      raise IOError("Malformed reply from fork server")
+    return (parts[0], parts[1:])
+
+  def Run(self, request, timeout):
+    """Runs a test and returns its output, or None if the server has
+    died and can not be used any longer."""
+    start = time.time()
+    try:
+      self.process.stdin.write(request + '\n')
+      self.process.stdin.flush()
+      (tag, values) = self.ReadRecord()
+      if tag != 'pid':
+        raise IOError("Malformed reply from fork server")
+      pid = int(values[0])
+    except (IOError, ValueError):
+      return None
+    RUNNING_PIDS_LOCK.acquire()
+    RUNNING_PIDS.add(pid)
+    RUNNING_PIDS_LOCK.release()
+    timed_out = [ False ]
+    def OnTimeout():
+      timed_out[0] = True
+      KillProcessWithID(pid)
+    watchdog = None
+    if timeout is not None:
+      watchdog = threading.Timer(timeout, OnTimeout)
+      watchdog.start()
+    try:
+      try:
+        stdout = [ ]
+        stderr = [ ]
+        while True:
+          (tag, values) = self.ReadRecord()
+          if tag == 'out':
+            stdout.append(self.process.stdout.read(int(values[0])))
+          elif tag == 'err':
+            stderr.append(self.process.stdout.read(int(values[0])))
+          elif tag == 'status':
+            (exit_code, user_time, system_time, max_rss) = values
+            usage = ResourceUsage(time.time() - start,
+                                  float(user_time),
+                                  float(system_time),
+                                  NormalizeMaxRss(int(max_rss)))
+            return CommandOutput(int(exit_code), "".join(stdout),
+                                 "".join(stderr), timed_out[0], usage)
+          else:
+            raise IOError("Malformed reply from fork server")
+      except (IOError, ValueError):
+        KillProcessWithID(pid)
+        return None
+    finally:
+      if watchdog:
+        watchdog.cancel()
+      RUNNING_PIDS_LOCK.acquire()
+      RUNNING_PIDS.discard(pid)
+      RUNNING_PIDS_LOCK.release()
+
+  def Stop(self):
+    try:
+      self.process.stdin.close()
+    except IOError:
+      pass
+    KillProcessWithID(self.process.pid)
+    self.process.wait()
+    RUNNING_PIDS_LOCK.acquire()
+    RUNNING_PIDS.discard(self.process.pid)
+    RUNNING_PIDS_LOCK.release()
+
+
+class ForkServerPool(object):
+  """The fork servers started so far, keyed by the command that started
+  them.  Each server runs one test at a time so parallel tasks get a
+  server each."""
+
+  def __init__(self, context):
+    self.context = context
+    self.idle = { }
+    self.all = [ ]
+    self.lock = threading.Lock()
+
+  def Run(self, command, request, timeout):
+    key = tuple(command)
+    self.lock.acquire()
+    try:
+      idle = self.idle.setdefault(key, [ ])
+      if idle:
+        server = idle.pop()
+      else:
+        server = ForkServer(self.context, command)
+        self.all.append(server)
+    finally:
+      self.lock.release()
+    output = server.Run(request, timeout)
+    self.lock.acquire()
+    try:
+      if output is None:
+        # The server is broken; the caller will fall back to running
+        # the test in a process of its own.
+        self.all.remove(server)
+        server.Stop()
+      else:
+        self.idle[key].append(server)
+    finally:
+      self.lock.release()
+    return output
+
+  def Stop(self):
+    self.lock.acquire()
+    try:
+      for server in self.all:
+        server.Stop()
+      self.all = [ ]
+      self.idle = { }
+    finally:
+      self.lock.release()
 
 
 def CarCdr(path):
@@ -396,6 +981,9 @@ class TestConfiguration(object):
         return False
     return True
 
+  def GetStatusFile(self):
+    return None
+
   def GetTestStatus(self, sections, defs):
     pass
 
@@ -441,6 +1029,13 @@ class TestRepository(TestSuite):
   def GetTestStatus(self, context, sections, defs):
     self.GetConfiguration(context).GetTestStatus(sections, defs)
 
+  def GetStatusFiles(self, context):
+    status_file = self.GetConfiguration(context).GetStatusFile()
+    if status_file:
+      return {self.GetName(): status_file}
+    else:
+      return { }
+
 
 class LiteralTestSuite(TestSuite):
 
@@ -470,19 +1065,59 @@ class LiteralTestSuite(TestSuite):
     for test in self.tests:
       test.GetTestStatus(context, sections, defs)
 
+  def GetStatusFiles(self, context):
+    result = { }
+    for test in self.tests:
+      result.update(test.GetStatusFiles(context))
+    return result
+
 
 PREFIX = {'debug': '_g', 'release': ''}
 
+# How many times slower than a release build on real hardware the tests
+# run in each mode and on each simulator.
+TIMEOUT_SCALEFACTOR = {'debug': 4, 'release': 1}
+SIMULATOR_SCALEFACTOR = {'arm': 8}
+
+# A test that has run before gets this many times its slowest recorded
+# running time.
+TIMEOUT_MARGIN = 3
+
 
 class Context(object):
 
-  def __init__(self, workspace, buildspace, verbose, vm, timeout, processor):
+  def __init__(self, workspace, buildspace, verbose, vm, timeout, processor,
+               history):
     self.workspace = workspace
     self.buildspace = buildspace
     self.verbose = verbose
     self.vm_root = vm
     self.timeout = timeout
     self.processor = processor
+    self.history = history
+    self.cache = None
+    self.servers = None
+    self.discovery = DiscoveryCache(None)
+    self.min_timeout = 0
+    self.simulator = 'none'
+    self.profile_dir = None
+
+  def GetTimeout(self, case):
+    """Returns the timeout for a test case.  The timeout given on the
+    command line is scaled for the mode and simulator and used for tests
+    that have never run.  It also bounds the timeout of the other tests,
+    which is derived from their recorded running times but never less
+    than the minimum timeout."""
+    simulator_factor = SIMULATOR_SCALEFACTOR.get(self.simulator, 1)
+    ceiling = (self.timeout * TIMEOUT_SCALEFACTOR.get(case.mode, 1)
+               * simulator_factor)
+    slowest = self.history.GetSlowest(case)
+    if slowest is None:
+      return ceiling
+    # The history is kept per simulator so the recorded times already
+    # include its slowdown.
+    timeout = TIMEOUT_MARGIN * slowest
+    return min(max(timeout, self.min_timeout), ceiling)
 
   def GetVm(self, mode):
     name = self.vm_root + PREFIX[mode]
@@ -491,19 +1126,698 @@ class Context(object):
     else:
       return name
 
-def RunTestCases(all_cases, progress):
+
+class TestHistory(object):
+  """The running times and peak memory use of tests in previous runs
+  and how often they passed and failed.  They are kept in a file between
+  runs, keyed by the path of the test, the mode it ran in and the
+  simulator it ran on."""
+
+  # The number of recent running times remembered for each test.
+  MAX_SAMPLES = 10
+
+  def __init__(self, path):
+    self.path = path
+    self.durations = { }
+    self.outcomes = { }
+    self.memory = { }
+    if path and exists(path):
+      try:
+        contents = json.load(open(path))
+        self.durations = contents['durations']
+        self.outcomes = contents.get('outcomes', { })
+        self.memory = contents.get('memory', { })
+      except (IOError, ValueError, KeyError), e:
+        PrintError("Ignoring unreadable test history %s: %s" % (path, e))
+
+  def GetKey(self, case):
+    return GetResultKey(case)
+
+  def GetEstimate(self, case):
+    """Returns the median of the recorded running times of the given
+    test case or None if it has never been run."""
+    samples = self.durations.get(self.GetKey(case))
+    if not samples:
+      return None
+    return sorted(samples)[len(samples) // 2]
+
+  def GetSlowest(self, case):
+    """Returns the longest recorded running time of the given test case
+    or None if it has never been run."""
+    samples = self.durations.get(self.GetKey(case))
+    if not samples:
+      return None
+    return max(samples)
+
+  def Record(self, case, duration):
+    self.RecordKey(self.GetKey(case), duration)
+
+  def RecordKey(self, key, duration):
+    samples = self.durations.setdefault(key, [ ])
+    samples.append(round(duration, 3))
+    del samples[:-TestHistory.MAX_SAMPLES]
+
+  def RecordOutcome(self, case, failed):
+    self.RecordOutcomeKey(self.GetKey(case), failed)
+
+  def RecordOutcomeKey(self, key, failed):
+    counts = self.outcomes.setdefault(key, [0, 0])
+    if failed:
+      counts[1] += 1
+    else:
+      counts[0] += 1
+
+  def GetMemoryEstimate(self, case):
+    """Returns the largest recorded peak memory use of the given test
+    case in kilobytes or None if it is not known."""
+    samples = self.memory.get(self.GetKey(case))
+    if not samples:
+      return None
+    return max(samples)
+
+  def RecordMemory(self, case, max_rss):
+    self.RecordMemoryKey(self.GetKey(case), max_rss)
+
+  def RecordMemoryKey(self, key, max_rss):
+    samples = self.memory.setdefault(key, [ ])
+    samples.append(max_rss)
+    del samples[:-TestHistory.MAX_SAMPLES]
+
+  def GetOutcomeCounts(self, case):
+    """Returns the number of recorded runs in which the given test case
+    passed and failed."""
+    return tuple(self.outcomes.get(self.GetKey(case), [0, 0]))
+
+  def Save(self):
+    if not self.path:
+      return
+    # Write to a temporary file first so an interrupted run does not
+    # leave a truncated history behind.
+    temp = self.path + '.tmp'
+    out = open(temp, 'w')
+    try:
+      json.dump({
+        'durations': self.durations,
+        'outcomes': self.outcomes,
+        'memory': self.memory
+      }, out)
+    finally:
+      out.close()
+    if platform.system() == 'Windows' and exists(self.path):
+      os.unlink(self.path)
+    os.rename(temp, self.path)
+
+
+def ToBytes(value):
+  """Converts the unicode strings in a value loaded from JSON back into
+  plain strings."""
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  elif isinstance(value, list):
+    return [ ToBytes(x) for x in value ]
+  else:
+    return value
+
+
+class DiscoveryCache(object):
+  """Results of test discovery, such as the list of tests in a binary
+  or the contents of a directory, kept between runs.  Each result is
+  stored together with the modification time and size of the file or
+  directory it was computed from and is recomputed when they change."""
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = { }
+    self.dirty = False
+    self.lock = threading.Lock()
+    if path and exists(path):
+      try:
+        self.entries = json.load(open(path))
+      except (IOError, ValueError), e:
+        PrintError("Ignoring unreadable discovery cache %s: %s" % (path, e))
+
+  def GetStamp(self, name):
+    try:
+      stat = os.stat(name)
+    except OSError:
+      return None
+    return [stat.st_mtime, stat.st_size]
+
+  def Get(self, kind, name, compute):
+    """Returns the cached result of the given kind for the given file,
+    calling compute() if there is none or the file has changed.  Results
+    that are None are not cached."""
+    key = "%s:%s" % (kind, name)
+    stamp = self.GetStamp(name)
+    self.lock.acquire()
+    try:
+      entry = self.entries.get(key)
+    finally:
+      self.lock.release()
+    if entry and stamp and entry['stamp'] == stamp:
+      return ToBytes(entry['value'])
+    value = compute()
+    if stamp and value is not None:
+      self.lock.acquire()
+      try:
+        self.entries[key] = {'stamp': stamp, 'value': value}
+        self.dirty = True
+      finally:
+        self.lock.release()
+    return value
+
+  def ListDir(self, path):
+    """Returns the names of the subdirectories and files of a directory
+    as a (dirs, files) pair."""
+    def Compute():
+      dirs = [ ]
+      files = [ ]
+      for name in os.listdir(path):
+        if os.path.isdir(join(path, name)):
+          dirs.append(name)
+        else:
+          files.append(name)
+      return [dirs, files]
+    return self.Get('listdir', path, Compute)
+
+  def Save(self):
+    if not self.path or not self.dirty:
+      return
+    temp = self.path + '.tmp'
+    out = open(temp, 'w')
+    try:
+      json.dump(self.entries, out)
+    finally:
+      out.close()
+    if platform.system() == 'Windows' and exists(self.path):
+      os.unlink(self.path)
+    os.rename(temp, self.path)
+    self.dirty = False
+
+
+class ResultCache(object):
+  """Outputs of earlier test runs, keyed by a hash of everything that
+  determines the output: the executable, the test and framework files
+  and flags on the command line and the status file of the suite."""
+
+  # Entries that have not been used for this many seconds are dropped,
+  # and the least recently used beyond this number of entries.
+  MAX_AGE = 14 * 24 * 60 * 60
+  MAX_ENTRIES = 100000
+
+  def __init__(self, path, status_files, reuse):
+    self.path = path
+    self.status_files = status_files
+    self.reuse = reuse
+    self.entries = { }
+    self.used = { }
+    self.digests = { }
+    self.hits = 0
+    self.lock = threading.Lock()
+    self.entries = self.Load()
+
+  def Load(self):
+    if not exists(self.path):
+      return { }
+    try:
+      entries = json.load(open(self.path))
+    except (IOError, ValueError), e:
+      PrintError("Ignoring unreadable result cache %s: %s" % (self.path, e))
+      return { }
+    # Entries written before they were timestamped count as used now.
+    now = time.time()
+    for entry in entries.values():
+      entry.setdefault('time', now)
+    return entries
+
+  def GetFileDigest(self, name):
+    # Files are only hashed once per run; the shell and cctest binaries
+    # are shared by all tests of a mode.
+    self.lock.acquire()
+    try:
+      if not name in self.digests:
+        self.digests[name] = hashlib.sha1(open(name, 'rb').read()).hexdigest()
+      return self.digests[name]
+    finally:
+      self.lock.release()
+
+  def GetKey(self, case, command):
+    hash = hashlib.sha1()
+    for arg in command:
+      if os.path.isfile(arg):
+        hash.update('file:' + self.GetFileDigest(arg))
+      else:
+        hash.update('arg:' + arg)
+      hash.update('\0')
+    status_file = self.status_files.get(case.path[0])
+    if status_file and exists(status_file):
+      hash.update('status:' + self.GetFileDigest(status_file))
+    return hash.hexdigest()
+
+  def Lookup(self, key):
+    self.lock.acquire()
+    try:
+      entry = self.entries.get(key)
+      if not self.reuse or entry is None:
+        return None
+      entry['time'] = time.time()
+      self.used[key] = entry
+      self.hits += 1
+    finally:
+      self.lock.release()
+    return CommandOutput(entry['exit_code'],
+                         entry['stdout'].encode('latin-1'),
+                         entry['stderr'].encode('latin-1'))
+
+  def Store(self, key, output):
+    self.lock.acquire()
+    try:
+      # The output is arbitrary bytes; latin-1 maps them one to one
+      # onto characters that can be stored as JSON.
+      self.used[key] = {
+        'exit_code': output.exit_code,
+        'stdout': output.stdout.decode('latin-1'),
+        'stderr': output.stderr.decode('latin-1'),
+        'time': time.time()
+      }
+    finally:
+      self.lock.release()
+
+  def Save(self):
+    # The entries of this run are merged into the ones on disk, which
+    # another run may have changed since they were loaded, so that running
+    # some of the tests keeps the results of the others.  Entries for an
+    # older binary or test never match again and are eventually pruned.
+    entries = self.Load()
+    entries.update(self.used)
+    oldest = time.time() - ResultCache.MAX_AGE
+    keys = [ k for (k, e) in entries.items() if e['time'] >= oldest ]
+    keys.sort(key=lambda k: entries[k]['time'], reverse=True)
+    entries = dict([ (k, entries[k]) for k in keys[:ResultCache.MAX_ENTRIES] ])
+    temp = self.path + '.tmp'
+    out = open(temp, 'w')
+    try:
+      json.dump(entries, out)
+    finally:
+      out.close()
+    if platform.system() == 'Windows' and exists(self.path):
+      os.unlink(self.path)
+    os.rename(temp, self.path)
+
+
+def EstimateMemory(case, history):
+  """Returns the peak memory use of a test in megabytes as declared in
+  the status file or, failing that, as recorded in earlier runs.  Tests
+  that have never been run are assumed to need nothing."""
+  if case.memory is not None:
+    return case.memory
+  max_rss = history.GetMemoryEstimate(case)
+  if max_rss is None:
+    return 0
+  return max_rss // 1024
+
+
+def SortByDuration(cases, history):
+  """Orders the cases so that the slowest tests are started first,
+  which keeps the last few tests of a parallel run from stretching the
+  total running time.  Tests without history are started before all
+  others since they may well be slow too."""
+  def GetSortKey(test):
+    estimate = history.GetEstimate(test.case)
+    if estimate is None:
+      return (0, 0)
+    else:
+      return (1, -estimate)
+  cases.sort(key=GetSortKey)
+
+
+def ProjectRunningTime(cases, history, tasks):
+  """Estimates how long it will take to run the given cases, both
+  serially and distributed over the given number of tasks.  Returns the
+  two estimates and the number of cases that have no history."""
+  estimates = [ history.GetEstimate(c.case) for c in cases ]
+  known = [ e for e in estimates if e is not None ]
+  known.sort(reverse=True)
+  # Simulate handing out the tests, longest first, to whichever task
+  # becomes available first.
+  loads = [ 0.0 ] * tasks
+  for estimate in known:
+    heapq.heapreplace(loads, loads[0] + estimate)
+  return (sum(known), max(loads), len(estimates) - len(known))
+
+
+def GetCasesToRun(all_cases):
   def DoSkip(case):
-    return SKIP in c.outcomes or SLOW in c.outcomes
-  cases_to_run = [ c for c in all_cases if not DoSkip(c) ]
-  progress = PROGRESS_INDICATORS[progress](cases_to_run)
-  return progress.Run()
+    return SKIP in case.outcomes or SLOW in case.outcomes
+  return [ c for c in all_cases if not DoSkip(c) ]
+
+
+def SelectShard(cases, count, index, history):
+  """Partitions the cases into the given number of shards and returns
+  the cases of the shard with the given index.  Without a history the
+  cases are assigned by a hash of their name.  With one, the shards are
+  balanced using the recorded running times, so every shard must be
+  given the same history and it must not change between their runs."""
+  keys = [ GetResultKey(c.case) for c in cases ]
+  if history is None:
+    estimates = [ None for c in cases ]
+  else:
+    estimates = [ history.GetEstimate(c.case) for c in cases ]
+  known = [ e for e in estimates if e is not None ]
+  if not known:
+    def GetShard(key):
+      return int(hashlib.md5(key).hexdigest()[:8], 16) % count
+    return [ c for (c, k) in zip(cases, keys) if GetShard(k) == index ]
+  # Tests that have not been timed are assumed to take the average
+  # time of the ones that have.
+  default = sum(known) / len(known)
+  order = [ ]
+  for (case, key, estimate) in zip(cases, keys, estimates):
+    if estimate is None:
+      estimate = default
+    order.append((-estimate, key, case))
+  order.sort()
+  # Hand out the tests longest first to the least loaded shard, which
+  # is the one with the lowest index among the equally loaded.
+  loads = [ (0.0, i) for i in xrange(count) ]
+  result = [ ]
+  for (estimate, key, case) in order:
+    (load, shard) = heapq.heappop(loads)
+    heapq.heappush(loads, (load - estimate, shard))
+    if shard == index:
+      result.append(case)
+  return result
+
+
+def GetResultKey(case):
+  """Returns the key a test case is known by in the history and the
+  results of a shard.  Running on a simulator changes how long a test
+  takes, so the simulator is part of the key."""
+  key = "%s/%s" % ("/".join(case.path), case.mode)
+  simulator = case.context.simulator
+  if simulator != 'none':
+    key += ":" + simulator
+  return key
+
+
+def WriteResults(path, all_cases, outputs, shard):
+  """Writes the results of a run to a file in a form that can be
+  merged with the results of other shards by --merge-results.  Besides
+  its own results every shard lists the tests of all the shards, so the
+  merge can tell whether each test ran exactly once."""
+  def GetString(str):
+    return str.decode('latin-1')
+  tests = [ ]
+  for output in outputs:
+    case = output.test
+    record = {
+      'key': GetResultKey(case),
+      'label': case.GetLabel(),
+      'path': "/".join(case.path),
+      'failed': bool(output.HasFailed()),
+      'unexpected': bool(output.UnexpectedOutput()),
+      'duration': output.duration,
+      'cached': output.cached
+    }
+    if output.output.usage:
+      record['max_rss'] = output.output.usage.max_rss
+    if output.UnexpectedOutput():
+      record['command'] = GetString(EscapeCommand(output.command))
+      record['stdout'] = GetString(output.output.stdout)
+      record['stderr'] = GetString(output.output.stderr)
+      record['timed_out'] = output.output.timed_out
+    tests.append(record)
+  results = {
+    'shard': [shard['index'], shard['count']],
+    'expected': shard['expected'],
+    'total': len(all_cases),
+    'skipped': len(all_cases) - len(GetCasesToRun(all_cases)),
+    'tests': tests
+  }
+  out = open(path, 'w')
+  try:
+    json.dump(results, out)
+  finally:
+    out.close()
+
+
+def MergeResults(files, history):
+  """Combines the results files written by the shards of a run into one
+  report.  The running times are added to the history so the next run
+  can be balanced better.  Tests that ran in more than one shard are
+  reported, and so are tests that ran in none, which fails the merge."""
+  total = 0
+  skipped = 0
+  tests = [ ]
+  expected = None
+  consistent = True
+  for name in files:
+    results = json.load(open(name))
+    total += results['total']
+    skipped += results['skipped']
+    tests += results['tests']
+    if 'expected' in results:
+      keys = set(results['expected'])
+      if expected is None:
+        expected = keys
+      elif keys != expected:
+        consistent = False
+        expected |= keys
+  counts = { }
+  for test in tests:
+    counts[test['key']] = counts.get(test['key'], 0) + 1
+  duplicated = sorted([ k for (k, n) in counts.items() if n > 1 ])
+  missing = [ ]
+  if expected is not None:
+    missing = sorted(expected - set(counts.keys()))
+  failed = [ t for t in tests if t['unexpected'] ]
+  for test in tests:
+    if test['duration'] is not None and not test['cached']:
+      history.RecordKey(test['key'], test['duration'])
+      history.RecordOutcomeKey(test['key'], test['failed'])
+    if test.get('max_rss') is not None:
+      history.RecordMemoryKey(test['key'], test['max_rss'])
+  history.Save()
+  print "=== %i result files: %i tests, %i skipped, %i run" % (len(files),
+      total, skipped, len(counts))
+  if not consistent:
+    print "=== The shards listed different tests; were they run on the same tree?"
+  if duplicated:
+    print "=== %i tests ran in more than one shard:" % len(duplicated)
+    for key in duplicated:
+      print "===   %s (%i times)" % (key, counts[key])
+  if missing:
+    print "=== %i tests did not run in any shard:" % len(missing)
+    for key in missing:
+      print "===   %s" % key
+  for test in failed:
+    print "=== %s (%s) ===" % (test['label'], test['path'])
+    if test['stderr']:
+      print "--- stderr ---"
+      print test['stderr'].encode('latin-1').strip()
+    if test['stdout']:
+      print "--- stdout ---"
+      print test['stdout'].encode('latin-1').strip()
+    if test['timed_out']:
+      print "--- TIMEOUT ---"
+    print "Command: %s" % test['command'].encode('latin-1')
+  if len(failed) == 0 and not missing:
+    print "==="
+    print "=== All tests succeeded"
+    print "==="
+    return 0
+  elif len(failed) == 0:
+    return 1
+  else:
+    print
+    print "==="
+    print "=== %i tests failed" % len(failed)
+    print "==="
+    return 1
+
+
+# The number of functions listed in the profile of each suite and the
+# number of functions for which the tests that spend the most time in
+# them are listed.
+PROFILE_HOTSPOTS = 25
+PROFILE_HOTSPOT_TESTS = 10
+PROFILE_TESTS_PER_HOTSPOT = 5
+
+
+def ProcessProfile(log):
+  """Runs a profiler log through the tick processor and returns the
+  number of ticks in it and a list of (kind, name, ticks) entries for
+  the code the ticks fell in.  Runs in a worker process."""
+  name = 'linux_tick_processor'
+  if name in sys.modules:
+    module = sys.modules[name]
+  else:
+    script = join(dirname(abspath(__file__)), 'linux-tick-processor.py')
+    module = imp.load_source(name, script)
+  processor = module.LinuxTickProcessor()
+  processor.ProcessLogfile(log)
+  entries = [ ]
+  for entry in processor.js_entries.ExportValueList() + processor.deleted_code:
+    if entry.tick_count > 0:
+      entries.append(('JavaScript', entry.ToString(), entry.tick_count))
+  for entry in processor.cpp_entries.ExportValueList():
+    if entry.tick_count > 0:
+      if entry.IsSharedLibraryEntry():
+        kind = 'Library'
+      else:
+        kind = 'C++'
+      entries.append((kind, entry.ToString(), entry.tick_count))
+  return (processor.total_number_of_ticks, entries)
+
+
+def PrintProfileReport(cases):
+  """Processes the profiler logs of the given test cases in parallel and
+  prints the functions most ticks fell in for each suite, together with
+  the tests that spent the most time in them."""
+  logs = [ (c, c.GetProfileLog()) for c in cases if exists(c.GetProfileLog()) ]
+  if not logs:
+    print "No profiler logs were written."
+    return
+  pool = multiprocessing.Pool(GetCpuCount())
+  try:
+    profiles = pool.map(ProcessProfile, [ log for (case, log) in logs ])
+  finally:
+    pool.close()
+    pool.join()
+  suites = { }
+  for ((case, log), (ticks, entries)) in zip(logs, profiles):
+    suite = suites.setdefault(case.path[0], {
+      'tests': 0,
+      'ticks': 0,
+      'entries': { },
+      'by_test': { }
+    })
+    suite['tests'] += 1
+    suite['ticks'] += ticks
+    for (kind, name, count) in entries:
+      key = (kind, name)
+      suite['entries'][key] = suite['entries'].get(key, 0) + count
+      suite['by_test'].setdefault(key, [ ]).append((count, case))
+  for name in sorted(suites.keys()):
+    suite = suites[name]
+    print
+    print "Statistical profiling result of %s, %i tests (%i ticks)." % (
+        name, suite['tests'], suite['ticks'])
+    if suite['ticks'] == 0:
+      continue
+    hotspots = sorted(suite['entries'].items(), key=lambda e: e[1],
+                      reverse=True)[:PROFILE_HOTSPOTS]
+    print
+    print " [Hotspots]:"
+    print "   total   ticks   kind        name"
+    for ((kind, function), count) in hotspots:
+      print "  %5.1f%% %7i   %-10s  %s" % (count * 100.0 / suite['ticks'],
+                                            count, kind, function)
+    print
+    print " [Tests with the most ticks in each hotspot]:"
+    for ((kind, function), count) in hotspots[:PROFILE_HOTSPOT_TESTS]:
+      print "   %s" % function
+      tests = sorted(suite['by_test'][(kind, function)], key=lambda t: t[0],
+                     reverse=True)[:PROFILE_TESTS_PER_HOTSPOT]
+      for (ticks, case) in tests:
+        print "     %7i   %s (%s)" % (ticks, "/".join(case.path), case.mode)
+
+
+def RunTestCases(all_cases, progress, tasks, context, results_file=None,
+                 shard=None, records_file=None, retries=0, more_cases=None,
+                 memory_budget=None):
+  history = context.history
+  cases_to_run = GetCasesToRun(all_cases)
+  SortByDuration(cases_to_run, history)
+  def Feed():
+    # Runs in the background while the first round runs, adding the
+    # tests that become available to the ones to run.
+    for cases in more_cases:
+      all_cases.extend(cases)
+      batch = GetCasesToRun(cases)
+      SortByDuration(batch, history)
+      cases_to_run.extend(batch)
+      yield batch
+  feeder = None
+  if more_cases:
+    feeder = Feed()
+  records = None
+  if records_file:
+    records = open(records_file, 'a')
+  rounds = [ ]
+  try:
+    # Run all the tests once and then run the ones that failed
+    # unexpectedly again, up to the given number of times.
+    cases = cases_to_run
+    while True:
+      indicator = PROGRESS_INDICATORS[progress](cases)
+      indicator.records = records
+      if memory_budget:
+        indicator.scheduler.SetMemoryBudget(memory_budget,
+            lambda case: EstimateMemory(case, history))
+      rounds.append(indicator)
+      result = indicator.Run(tasks, feeder)
+      feeder = None
+      if result or len(rounds) > retries:
+        break
+      failed = set([ id(output.test) for output in indicator.failed_tests ])
+      cases = [ c for c in cases if id(c.case) in failed ]
+      print "=== Retrying %i failed tests" % len(cases)
+    # The last output of each test is its final result.
+    final = { }
+    for (attempt, indicator) in enumerate(rounds):
+      for output in indicator.outputs:
+        final[id(output.test)] = (attempt, output)
+    flaky = [ o for (a, o) in final.values() if a > 0 and not o.UnexpectedOutput() ]
+    if flaky:
+      print "=== %i tests failed at first but passed when retried:" % len(flaky)
+      for output in flaky:
+        print "===   %s" % output.test.GetLabel()
+    if results_file:
+      WriteResults(results_file, all_cases, [ o for (a, o) in final.values() ],
+                   shard)
+    return result
+  finally:
+    for indicator in rounds:
+      for output in indicator.outputs:
+        if not output.cached:
+          history.Record(output.test, output.duration)
+          history.RecordOutcome(output.test, output.HasFailed())
+          if output.output.usage:
+            history.RecordMemory(output.test, output.output.usage.max_rss)
+    history.Save()
+    context.discovery.Save()
+    if records:
+      records.close()
+    if context.servers:
+      context.servers.Stop()
+    if context.cache:
+      context.cache.Save()
+      print "=== %i of %i tests were served from the result cache" % (
+          context.cache.hits, len(cases_to_run))
+
+
+def GetCpuCount():
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
 
 
-def BuildRequirements(context, requirements, mode, scons_flags):
+def BuildRequirements(context, requirements, mode, scons_flags, log=None):
+  """Builds the given targets.  If a log list is given the output of
+  the build is captured and appended to it instead of going to the
+  terminal, for builds that run while a progress indicator is active."""
   command_line = (['scons', '-Y', context.workspace, 'mode=' + ",".join(mode)]
                   + requirements
                   + scons_flags)
-  output = ExecuteNoCapture(command_line, context)
+  if not [f for f in scons_flags if f.startswith('-j') or f.startswith('--jobs')]:
+    command_line.append('-j%i' % GetCpuCount())
+  if log is None:
+    output = ExecuteNoCapture(command_line, context)
+  else:
+    output = Execute(command_line, context)
+    log.append(output.stdout + output.stderr)
   return output.exit_code == 0
 
 
@@ -519,6 +1833,16 @@ OKAY = 'okay'
 TIMEOUT = 'timeout'
 CRASH = 'crash'
 SLOW = 'slow'
+# Tests marked with this must not share a process with other tests.  Like
+# the resource annotations below it is not an outcome.
+ISOLATE = 'isolate'
+# Tests marked with this run on their own, with no other test running at
+# the same time.  Not an outcome either.
+EXCLUSIVE = 'exclusive'
+# MEM_<n> marks a test that needs n megabytes of memory, CPU_<n> one that
+# keeps n CPUs busy.  The scheduler uses these to avoid overloading the
+# machine.
+RESOURCE_PATTERN = re.compile(r'^(mem|cpu)_(\d+)$')
 
 
 class Expression(object):
@@ -822,18 +2146,43 @@ class Configuration(object):
   def __init__(self, sections, defs):
     self.sections = sections
     self.defs = defs
+    self.compiled = { }
+
+  def Compile(self, env):
+    """Returns the rules that apply in the given environment, indexed
+    by their paths.  The result is computed once per environment."""
+    key = tuple(sorted(env.items()))
+    if not key in self.compiled:
+      sections = [s for s in self.sections if s.condition.Evaluate(env, self.defs)]
+      all_rules = reduce(list.__add__, [s.rules for s in sections], [])
+      self.compiled[key] = RuleIndex(all_rules, env, self.defs)
+    return self.compiled[key]
 
   def ClassifyTests(self, cases, env):
-    sections = [s for s in self.sections if s.condition.Evaluate(env, self.defs)]
-    all_rules = reduce(list.__add__, [s.rules for s in sections], [])
-    unused_rules = set(all_rules)
+    index = self.Compile(env)
+    unused_rules = set(index.rules)
     result = [ ]
     for case in cases:
-      matches = [ r for r in all_rules if r.Contains(case.path) ]
+      matches = index.GetMatches(case.path)
       outcomes = set([])
       for rule in matches:
-        outcomes = outcomes.union(rule.GetOutcomes(env, self.defs))
+        outcomes = outcomes.union(index.GetOutcomes(rule))
         unused_rules.discard(rule)
+      # Resource annotations are not outcomes; take them out.
+      resources = [ o for o in outcomes if RESOURCE_PATTERN.match(o) ]
+      for resource in resources:
+        (kind, amount) = RESOURCE_PATTERN.match(resource).groups()
+        if kind == 'mem':
+          case.memory = max(case.memory, int(amount))
+        else:
+          case.cpus = max(case.cpus, int(amount))
+      outcomes = outcomes.difference(resources)
+      if ISOLATE in outcomes:
+        case.isolate = True
+        outcomes = outcomes.difference([ISOLATE])
+      if EXCLUSIVE in outcomes:
+        case.exclusive = True
+        outcomes = outcomes.difference([EXCLUSIVE])
       if not outcomes:
         outcomes = [PASS]
       case.outcomes = outcomes
@@ -841,6 +2190,64 @@ class Configuration(object):
     return (result, list(unused_rules))
 
 
+class RuleIndexNode(object):
+
+  def __init__(self):
+    # Rules whose whole path leads to this node.
+    self.rules = [ ]
+    # Rules whose path leads to this node and continues with a wildcard.
+    self.wildcards = [ ]
+    self.children = { }
+
+
+class RuleIndex(object):
+  """The rules of the enabled sections of a configuration, arranged in
+  a trie keyed by the literal components of their paths.  A rule whose
+  path contains a wildcard is stored at the node for the components
+  before the wildcard.  Matching a test then only considers the rules
+  along its path instead of every rule in the configuration."""
+
+  def __init__(self, rules, env, defs):
+    self.rules = rules
+    self.env = env
+    self.defs = defs
+    self.root = RuleIndexNode()
+    self.outcomes = { }
+    for rule in rules:
+      self.Add(rule)
+
+  def Add(self, rule):
+    node = self.root
+    for part in rule.path:
+      if not part.IsLiteral():
+        node.wildcards.append(rule)
+        return
+      node = node.children.setdefault(part.pattern, RuleIndexNode())
+    node.rules.append(rule)
+
+  def GetMatches(self, path):
+    result = [ ]
+    node = self.root
+    depth = 0
+    while True:
+      result += node.rules
+      result += [ r for r in node.wildcards if r.Contains(path) ]
+      if depth == len(path):
+        break
+      node = node.children.get(path[depth])
+      if node is None:
+        break
+      depth += 1
+    return result
+
+  def GetOutcomes(self, rule):
+    # A rule's outcomes only depend on the environment so they are only
+    # computed once.
+    if not rule in self.outcomes:
+      self.outcomes[rule] = rule.GetOutcomes(self.env, self.defs)
+    return self.outcomes[rule]
+
+
 class Section(object):
   """A section of the configuration file.  Sections are enabled or
   disabled prior to running the tests, based on their conditions"""
@@ -946,8 +2353,15 @@ def BuildOptions():
       default=False, action="store_true")
   result.add_option("-s", "--suite", help="A test suite",
       default=[], action="append")
-  result.add_option("-t", "--timeout", help="Timeout in seconds",
+  result.add_option("-t", "--timeout",
+      help="Timeout in seconds for release mode tests that have not run "
+           "before and the most any release mode test is given; scaled "
+           "for debug mode and simulators",
       default=60, type="int")
+  result.add_option("--min-timeout",
+      help="The least time in seconds given to a test whose timeout is "
+           "derived from its recorded running times",
+      default=10, type="int")
   result.add_option("--arch", help='The architecture to run tests for',
       default='none')
   result.add_option("--simulator", help="Run tests with architecture simulator",
@@ -955,6 +2369,65 @@ def BuildOptions():
   result.add_option("--special-command", default=None)
   result.add_option("--cat", help="Print the source of the tests",
       default=False, action="store_true")
+  result.add_option("--history-file",
+      help="File in which the running times of tests are recorded",
+      default=".test-history")
+  result.add_option("--no-fork-server",
+      help="Start a new process for every test instead of forking it from a server",
+      default=False, action="store_true")
+  result.add_option("--cache",
+      help="Reuse the results of tests whose inputs have not changed",
+      default=False, action="store_true")
+  result.add_option("--no-cache",
+      help="Rerun all tests even with --cache (their results are still stored)",
+      default=False, action="store_true")
+  result.add_option("--cache-file", help="File in which test results are cached",
+      default=".test-cache")
+  result.add_option("--discovery-cache",
+      help="File in which the results of test discovery are cached",
+      default=".test-discovery")
+  result.add_option("--shard-count",
+      help="Split the tests into this many shards (for use with --shard-index)",
+      default=1, type="int")
+  result.add_option("--shard-index",
+      help="The shard to run, from 0 to the shard count minus one",
+      default=0, type="int")
+  result.add_option("--shard-history",
+      help="Balance the shards using the running times in this history "
+           "file, which must be the same for all shards and is not changed "
+           "by the run (by default tests are assigned by a hash of their name)",
+      default=None)
+  result.add_option("--shard-results",
+      help="File to write the results of this shard to, for --merge-results",
+      default=None)
+  result.add_option("--merge-results",
+      help="Merge the results files given as arguments into one report",
+      default=False, action="store_true")
+  result.add_option("--records",
+      help="Append a line of JSON with the outcome, running time, CPU time "
+           "and peak memory of every test to this file",
+      default=None)
+  result.add_option("--memory-budget",
+      help="Megabytes of memory that the tests running at the same time "
+           "may use together, according to the status files and the peak "
+           "memory recorded in earlier runs",
+      default=0, type="int")
+  result.add_option("--profile",
+      help="Run every test with the profiler on and print the functions "
+           "each suite spends the most time in",
+      default=False, action="store_true")
+  result.add_option("--profile-dir",
+      help="Directory the profiler logs of the tests are written to",
+      default=".test-profiles")
+  result.add_option("--retry-failed",
+      help="Run tests that fail unexpectedly again, up to this many times",
+      default=0, type="int")
+  result.add_option("--flake-threshold",
+      help="Failure rate above which --report lists a test as flaky",
+      default=0.05, type="float")
+  result.add_option("-j", "--jobs", dest="j",
+      help="The number of parallel tasks to run",
+      default=1, type="int")
   return result
 
 
@@ -966,6 +2439,14 @@ def ProcessOptions(options):
     if not mode in ['debug', 'release']:
       print "Unknown mode %s" % mode
       return False
+  if options.profile:
+    if platform.system() == 'Windows':
+      print "Profiling is not supported on Windows"
+      return False
+    # Every test has to run in a process of its own to write a log of
+    # its own, and cached results have no log.
+    options.no_fork_server = True
+    options.cache = False
   if options.simulator != 'none':
     # Simulator argument was set. Make sure arch and simulator agree.
     if options.simulator != options.arch:
@@ -981,6 +2462,15 @@ def ProcessOptions(options):
     # was found, set the arch to the guess.
     if options.arch == 'none':
       options.arch = ARCH_GUESS
+  if options.j < 1:
+    print "The number of parallel tasks must be at least 1"
+    return False
+  if options.shard_count < 1:
+    print "The number of shards must be at least 1"
+    return False
+  if not (0 <= options.shard_index < options.shard_count):
+    print "Shard index %i is out of range" % options.shard_index
+    return False
   return True
 
 
@@ -993,7 +2483,42 @@ Total: %(total)i tests
  * %(fail)4d tests are expected to fail that we should fix\
 """
 
-def PrintReport(cases):
+PROJECTION_TEMPLATE = """\
+Projected time: %(serial)s serially, %(parallel)s with %(tasks)i tasks
+ * %(unknown)4d tests have not been timed yet\
+"""
+
+
+def FormatTime(seconds):
+  seconds = int(seconds)
+  return "%i:%02i" % (seconds // 60, seconds % 60)
+
+
+def PrintFlakyTests(cases, history, threshold):
+  """Lists the tests that have both passed and failed in the recorded
+  runs, at least at the given rate, that the status file doesn't
+  already expect to be flaky."""
+  flaky = [ ]
+  for test in cases:
+    if SKIP in test.outcomes:
+      continue
+    if PASS in test.outcomes and FAIL in test.outcomes:
+      continue
+    (passed, failed) = history.GetOutcomeCounts(test.case)
+    if passed == 0 or failed == 0:
+      continue
+    rate = float(failed) / (passed + failed)
+    if rate >= threshold:
+      flaky.append((rate, passed + failed, history.GetKey(test.case)))
+  if not flaky:
+    return
+  flaky.sort(reverse=True)
+  print "Flaky tests that are not marked as such in the status files:"
+  for (rate, runs, key) in flaky:
+    print " * %3i%% of %3i runs failed: %s" % (rate * 100, runs, key)
+
+
+def PrintReport(cases, history, tasks, flake_threshold):
   def IsFlaky(o):
     return (PASS in o) and (FAIL in o) and (not CRASH in o) and (not OKAY in o)
   def IsFailOk(o):
@@ -1007,6 +2532,15 @@ def PrintReport(cases):
     'fail_ok': len([t for t in unskipped if IsFailOk(t.outcomes)]),
     'fail': len([t for t in unskipped if list(t.outcomes) == [FAIL]])
   }
+  (serial, parallel, unknown) = ProjectRunningTime(GetCasesToRun(cases),
+                                                   history, tasks)
+  print PROJECTION_TEMPLATE % {
+    'serial': FormatTime(serial),
+    'parallel': FormatTime(parallel),
+    'tasks': tasks,
+    'unknown': unknown
+  }
+  PrintFlakyTests(cases, history, flake_threshold)
 
 
 class Pattern(object):
@@ -1021,6 +2555,9 @@ class Pattern(object):
       self.compiled = re.compile(pattern)
     return self.compiled.match(str)
 
+  def IsLiteral(self):
+    return not '*' in self.pattern
+
   def __str__(self):
     return self.pattern
 
@@ -1054,6 +2591,9 @@ def Main():
     parser.print_help()
     return 1
 
+  if options.merge_results:
+    return MergeResults(args, TestHistory(options.history_file))
+
   workspace = abspath(join(dirname(sys.argv[0]), '..'))
   repositories = [TestRepository(join(workspace, 'test', name)) for name in BUILT_IN_TESTS]
   repositories += [TestRepository(a) for a in options.suite]
@@ -1067,43 +2607,103 @@ def Main():
       path = SplitPath(arg)
       paths.append(path)
 
-  # First build the required targets
   buildspace = abspath('.')
+  history = TestHistory(options.history_file)
+  shard_history = None
+  if options.shard_count > 1 and options.shard_history:
+    if not exists(options.shard_history):
+      print "Shard history %s does not exist" % options.shard_history
+      return 1
+    shard_history = TestHistory(options.shard_history)
+    # The next shards must see the same history as this one.
+    if (options.history_file and
+        abspath(options.history_file) == abspath(options.shard_history)):
+      history.path = None
+  expected_keys = [ ]
   context = Context(workspace, buildspace, VERBOSE,
                     join(buildspace, 'shell'),
                     options.timeout,
-                    GetSpecialCommandProcessor(options.special_command))
-  if not options.no_build:
-    reqs = [ ]
-    for path in paths:
-      reqs += root.GetBuildRequirements(path, context)
-    reqs = list(set(reqs))
-    if len(reqs) > 0:
-      if not BuildRequirements(context, reqs, options.mode, options.scons_flags):
-        return 1
+                    GetSpecialCommandProcessor(options.special_command),
+                    history)
+  context.discovery = DiscoveryCache(options.discovery_cache)
+  context.min_timeout = options.min_timeout
+  context.simulator = options.simulator
+  if options.profile:
+    context.profile_dir = abspath(options.profile_dir)
+    if not exists(context.profile_dir):
+      os.makedirs(context.profile_dir)
 
   # Get status for tests
   sections = [ ]
   defs = { }
   root.GetTestStatus(context, sections, defs)
   config = Configuration(sections, defs)
+  # Fork servers can't be used when the test commands are wrapped in a
+  # special command.
+  if (not options.no_fork_server and not options.special_command
+      and platform.system() != 'Windows'):
+    context.servers = ForkServerPool(context)
+  if options.cache:
+    context.cache = ResultCache(options.cache_file,
+                                root.GetStatusFiles(context),
+                                not options.no_cache)
+
+  reqs = [ ]
+  if not options.no_build:
+    for path in paths:
+      reqs += root.GetBuildRequirements(path, context)
+    reqs = list(set(reqs))
 
-  # List the tests
-  all_cases = [ ]
   all_unused = [ ]
   unclassified_tests = [ ]
-  for path in paths:
-    for mode in options.mode:
-      env = {
-        'mode': mode,
-        'system': platform.system().lower(),
-        'arch': options.arch
-      }
-      test_list = root.ListTests([], path, context, mode)
-      unclassified_tests += test_list
-      (cases, unused_rules) = config.ClassifyTests(test_list, env)
-      all_cases += cases
-      all_unused.append(unused_rules)
+  def ListModeTests(mode):
+    env = {
+      'mode': mode,
+      'system': platform.system().lower(),
+      'arch': options.arch
+    }
+    test_list = [ ]
+    for path in paths:
+      test_list += root.ListTests([], path, context, mode)
+    unclassified_tests.extend(test_list)
+    (cases, unused_rules) = config.ClassifyTests(test_list, env)
+    all_unused.append(unused_rules)
+    expected_keys.extend([ GetResultKey(c.case) for c in GetCasesToRun(cases) ])
+    if options.shard_count > 1:
+      cases = SelectShard(cases, options.shard_count, options.shard_index,
+                          shard_history)
+    return cases
+
+  # First build the required targets.  When more than one mode has to be
+  # built, build and list them one at a time so the tests of the first
+  # mode can run while the others build.
+  pipeline = (len(reqs) > 0 and len(options.mode) > 1
+              and not options.cat and not options.report)
+  if pipeline:
+    modes = options.mode[:1]
+  else:
+    modes = options.mode
+  if len(reqs) > 0:
+    if not BuildRequirements(context, reqs, modes, options.scons_flags):
+      return 1
+
+  # The remaining modes build while the tests run, so their output is
+  # kept back and only shown if a build fails.
+  build_failures = [ ]
+  def BuildRemainingModes():
+    for mode in options.mode[1:]:
+      log = [ ]
+      if not BuildRequirements(context, reqs, [mode], options.scons_flags,
+                               log):
+        build_failures.append((mode, "".join(log)))
+        return
+      yield ListModeTests(mode)
+
+  # List the tests
+  all_cases = [ ]
+  for mode in modes:
+    all_cases += ListModeTests(mode)
+  context.discovery.Save()
 
   if options.cat:
     visited = set()
@@ -1122,18 +2722,38 @@ def Main():
 #    print "Rule for '%s' was not used." % '/'.join([str(s) for s in rule.path])
 
   if options.report:
-    PrintReport(all_cases)
+    PrintReport(all_cases, history, options.j, options.flake_threshold)
 
-  if len(all_cases) == 0:
+  more_cases = None
+  if pipeline:
+    more_cases = BuildRemainingModes()
+  if len(all_cases) == 0 and not more_cases:
     print "No tests to run."
     return 0
   else:
     try:
-      if RunTestCases(all_cases, options.progress):
+      shard = {
+        'index': options.shard_index,
+        'count': options.shard_count,
+        'expected': expected_keys
+      }
+      result = RunTestCases(all_cases, options.progress, options.j, context,
+                            options.shard_results, shard, options.records,
+                            options.retry_failed, more_cases,
+                            options.memory_budget)
+      if options.profile:
+        PrintProfileReport([ c.case for c in GetCasesToRun(all_cases) ])
+      for (mode, log) in build_failures:
+        print "=== Building %s failed" % mode
+        sys.stdout.write(log)
+      if build_failures:
+        return 1
+      if result:
         return 0
       else:
         return 1
     except KeyboardInterrupt:
+      KillRunningProcesses()
       print "Interrupted"
       return 1
 
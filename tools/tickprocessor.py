@@ -25,7 +25,92 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import csv, splaytree, sys
+import bisect, csv, gzip, math, multiprocessing, os, splaytree, subprocess, sys
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Logs at least this large get their progress reported.
+PROGRESS_MIN_SIZE = 64 * 1024 * 1024
+
+# The number of log rows between progress reports.
+PROGRESS_INTERVAL = 1 << 18
+
+# The number of ticks in C++ code that are buffered and then resolved
+# to functions together.
+TICK_BATCH_SIZE = 1 << 16
+
+PAGE_SIZE = 4096
+
+# Call tree nodes with fewer than this percentage of the ticks are left
+# out of the printed trees.
+CALL_TREE_THRESHOLD = 2.0
+
+# The name of frames that are not in any known code.
+UNKNOWN_FRAME = '<unknown>'
+
+# The number of entries printed for each time window.
+TIME_WINDOW_ENTRIES = 5
+
+# The number of entries with a column of their own in the timeline.
+TIMELINE_ENTRIES = 20
+
+# The number of entries printed in each section of a profile diff.
+DIFF_ENTRIES = 30
+
+# Entries with fewer ticks in both profiles together are left out of
+# the relative changes of a profile diff.
+DIFF_MIN_TICKS = 10
+
+# Changes with a z score at least this large are marked as significant,
+# about 95% confidence for a single entry.
+DIFF_SIGNIFICANT_Z = 1.96
+
+# The interval between the ticks of the VM's profiler, in nanoseconds.
+TICK_INTERVAL = 10 * 1000 * 1000
+
+
+class LogInput(object):
+  """A log file opened for reading.  Logs ending in .gz and .xz are
+  decompressed on the fly and '-' reads the log from stdin."""
+
+  def __init__(self, filename):
+    self.raw = None
+    self.process = None
+    self.size = None
+    if filename == '-':
+      self.file = sys.stdin
+      return
+    if filename.endswith('.xz'):
+      # Python has no xz support of its own.
+      self.process = subprocess.Popen(['xz', '-dc', filename],
+                                      stdout=subprocess.PIPE)
+      self.file = self.process.stdout
+      return
+    self.raw = open(filename, 'rb')
+    self.size = os.fstat(self.raw.fileno()).st_size
+    if filename.endswith('.gz'):
+      self.file = gzip.GzipFile(fileobj=self.raw, mode='rb')
+    else:
+      self.file = self.raw
+
+  def GetProgress(self):
+    """Returns the fraction of the log read so far or None if the size
+    of the log is not known."""
+    if not self.size:
+      return None
+    return float(self.raw.tell()) / self.size
+
+  def Close(self):
+    if self.file is not sys.stdin:
+      self.file.close()
+    if self.raw:
+      self.raw.close()
+    if self.process:
+      self.process.wait()
 
 
 class CodeEntry(object):
@@ -35,8 +120,8 @@ class CodeEntry(object):
     self.tick_count = 0
     self.name = name
 
-  def IncrementTickCount(self):
-    self.tick_count += 1
+  def IncrementTickCount(self, count = 1):
+    self.tick_count += count
 
   def SetStartAddress(self, start_addr):
     self.start_addr = start_addr
@@ -68,57 +153,633 @@ class JSCodeEntry(CodeEntry):
     return self.name + ' ' + self.type
 
 
+class AddressRanges(object):
+  """A set of addresses, kept as sorted lists of the starts and ends of
+  the disjoint ranges it is made of."""
+
+  def __init__(self):
+    self.starts = []
+    self.ends = []
+
+  def Add(self, start, end):
+    # Merge the new range with the ranges it overlaps or touches.
+    first = bisect.bisect_left(self.ends, start)
+    last = bisect.bisect_right(self.starts, end)
+    if first < last:
+      start = min(start, self.starts[first])
+      end = max(end, self.ends[last - 1])
+    self.starts[first:last] = [start]
+    self.ends[first:last] = [end]
+
+  def Contains(self, addr):
+    i = bisect.bisect_right(self.starts, addr) - 1
+    return i >= 0 and addr < self.ends[i]
+
+
+class AddressIndex(object):
+  """A sorted array of start addresses that many addresses can be looked
+  up in at once, with NumPy if it is available."""
+
+  def __init__(self, starts):
+    self.starts = starts
+    if numpy is not None:
+      self.start_array = numpy.array(starts, dtype=numpy.uint64)
+
+  def Count(self, addresses):
+    """Returns a dictionary that maps i to the number of the given
+    addresses whose greatest start not above them is starts[i - 1].
+    Addresses below the first start are counted under 0."""
+    if numpy is not None:
+      found = numpy.searchsorted(self.start_array,
+                                 numpy.array(addresses, dtype=numpy.uint64),
+                                 side='right')
+      counts = numpy.bincount(found, minlength=len(self.starts) + 1)
+      return dict([(int(i), int(counts[i])) for i in numpy.nonzero(counts)[0]])
+    counts = {}
+    for addr in addresses:
+      i = bisect.bisect_right(self.starts, addr)
+      counts[i] = counts.get(i, 0) + 1
+    return counts
+
+  def Find(self, addresses):
+    """Returns, for each of the given addresses, the i that Count would
+    count it under."""
+    if numpy is not None:
+      found = numpy.searchsorted(self.start_array,
+                                 numpy.array(addresses, dtype=numpy.uint64),
+                                 side='right')
+      return [int(i) for i in found]
+    return [bisect.bisect_right(self.starts, addr) for addr in addresses]
+
+
+class SymbolIndex(AddressIndex):
+  """The entries of a code map that does not change any more, frozen into
+  an address index."""
+
+  def __init__(self, tree):
+    self.entries = tree.ExportValueList()
+    self.entries.sort(key=lambda e: e.start_addr)
+    AddressIndex.__init__(self, [e.start_addr for e in self.entries])
+
+  def CountAddresses(self, addresses):
+    """Returns a list of (entry, count) pairs giving the number of the
+    given addresses that fall in each entry, and the number of addresses
+    that fall below the first entry."""
+    counts = self.Count(addresses)
+    below = counts.pop(0, 0)
+    return ([(self.entries[i - 1], n) for (i, n) in counts.items()], below)
+
+  def FindEntries(self, addresses):
+    """Returns the entry each of the given addresses falls in, or None
+    for addresses below the first entry."""
+    entries = [None] + self.entries
+    return [entries[i] for i in self.Find(addresses)]
+
+
+class CodeVersions(object):
+  """The JavaScript code of a log with the addresses it lived at and the
+  ranges of log offsets during which it lived there, for the parallel
+  mode.  Replaying the code events this way gives the same code map at
+  the end as processing them in order."""
+
+  def __init__(self):
+    # The code objects; their index in this list is their id.
+    self.entries = []
+    # The id of the code living at each address and the offset of the
+    # event that put it there.
+    self.live = {}
+    # The (address, size, id, first offset, last offset) versions.
+    self.versions = []
+    self.deleted = []
+
+  def Create(self, offset, type, addr, size, name):
+    # Like the splay tree, ignore repeated insertions with the same key.
+    if addr in self.live:
+      return
+    self.live[addr] = (len(self.entries), offset)
+    self.entries.append(JSCodeEntry(addr, name, type, size))
+
+  def End(self, addr, offset):
+    (id, first) = self.live.pop(addr)
+    self.versions.append((addr, self.entries[id].size, id, first, offset))
+    return id
+
+  def Move(self, offset, from_addr, to_addr):
+    if not from_addr in self.live:
+      print('Code move event for unknown code: 0x%x' % from_addr)
+      return
+    id = self.End(from_addr, offset)
+    self.entries[id].SetStartAddress(to_addr)
+    if not to_addr in self.live:
+      self.live[to_addr] = (id, offset)
+
+  def Delete(self, offset, addr):
+    if not addr in self.live:
+      print('Code delete event for unknown code: 0x%x' % addr)
+      return
+    self.deleted.append(self.End(addr, offset))
+
+  def Finish(self, offset):
+    """Ends the versions still live at the end of the log and returns
+    the ids of their code."""
+    ids = [id for (id, first) in self.live.values()]
+    for addr in list(self.live.keys()):
+      self.End(addr, offset)
+    return ids
+
+  def SplitVersions(self, begins):
+    """Returns a list with, for each chunk of the log starting at the
+    given offsets, the versions that live during it."""
+    result = [[] for begin in begins]
+    for version in self.versions:
+      first = bisect.bisect_right(begins, version[3]) - 1
+      last = bisect.bisect_left(begins, version[4])
+      for i in range(max(first, 0), last):
+        result[i].append(version)
+    return result
+
+
+class CallTreeNode(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.total_ticks = 0
+    self.self_ticks = 0
+    self.children = {}
+
+  def GetChild(self, name):
+    child = self.children.get(name)
+    if child is None:
+      child = CallTreeNode(name)
+      self.children[name] = child
+    return child
+
+
+class CallTree(object):
+  """The call paths of the sampled ticks, merged into a tree of
+  functions.  Every node counts the ticks whose path goes through it and
+  the ticks whose path ends in it."""
+
+  def __init__(self):
+    self.root = CallTreeNode(None)
+
+  def AddPath(self, path, count = 1):
+    node = self.root
+    node.total_ticks += count
+    for name in path:
+      node = node.GetChild(name)
+      node.total_ticks += count
+    node.self_ticks += count
+
+
+class ProtoWriter(object):
+  """Encodes messages in the protocol buffer wire format, as much of it
+  as pprof profiles need."""
+
+  def __init__(self):
+    self.data = bytearray()
+
+  def Varint(self, value):
+    while value > 0x7f:
+      self.data.append((value & 0x7f) | 0x80)
+      value >>= 7
+    self.data.append(value)
+
+  def Int(self, field, value):
+    if value:
+      self.Varint(field << 3)
+      self.Varint(value)
+
+  def Bytes(self, field, data):
+    self.Varint((field << 3) | 2)
+    self.Varint(len(data))
+    self.data.extend(data)
+
+  def String(self, field, string):
+    if not isinstance(string, bytes):
+      string = string.encode('utf-8')
+    self.Bytes(field, bytearray(string))
+
+  def Message(self, field, message):
+    self.Bytes(field, message.data)
+
+  def PackedInts(self, field, values):
+    packed = ProtoWriter()
+    for value in values:
+      packed.Varint(value)
+    self.Message(field, packed)
+
+
+def GetEntryName(entry):
+  if entry is None:
+    return UNKNOWN_FRAME
+  return entry.ToString()
+
+
+def ParseStack(fields):
+  """Returns the return addresses logged after the state and the
+  optional overflow marker of a tick row."""
+  return [int(field, 16) for field in fields[4:] if field != 'overflow']
+
+
+def ProcessTickChunk(task):
+  """Resolves the ticks in a byte range of a log against the code that
+  lived during it.  Runs in a worker process of the parallel mode and
+  returns the tick counts."""
+  (filename, begin, end, versions, cpp_starts, extent, included_state,
+   current_time, time_window) = task
+  vm_extent = AddressRanges()
+  (vm_extent.starts, vm_extent.ends) = extent
+  # Code that lives when the chunk starts is in the map from the start,
+  # the rest is added and removed at the offsets of its events.  At the
+  # same offset removals (0) come before additions (1).
+  live = splaytree.SplayTree()
+  events = []
+  for (addr, size, id, first, last) in versions:
+    if first <= begin:
+      live.Insert(addr, (id, size))
+    else:
+      events.append((first, 1, addr, id, size))
+    if last < end:
+      events.append((last, 0, addr, id, size))
+  events.sort()
+  next_event = 0
+  cpp_ticks = []
+  js_counts = {}
+  # The frames of the ticks with stacks, innermost first.  JavaScript
+  # frames are ('js', id), C++ frames stay addresses until they are
+  # resolved with the others at the end.
+  stacks = []
+  # With a time window the ticks are also counted by (window, frame),
+  # with the windows of the C++ ticks and stacks kept beside them.
+  window = 0
+  if time_window is not None:
+    window = current_time // time_window
+  window_counts = {}
+  cpp_windows = []
+  stack_windows = []
+  def FindFrame(addr):
+    if vm_extent.Contains(addr):
+      return addr
+    node = live.FindGreatestsLessThan(addr)
+    if node and addr < node.key + node.value[1]:
+      return ('js', node.value[0])
+    return None
+  total = 0
+  unaccounted = 0
+  excluded = 0
+  logfile = open(filename, 'rb')
+  try:
+    logfile.seek(begin)
+    offset = begin
+    for line in logfile:
+      line_offset = offset
+      offset += len(line)
+      if line_offset >= end:
+        break
+      if line.startswith('time-marker,'):
+        current_time = max(current_time, int(line.split(',')[1]))
+        if time_window is not None:
+          window = current_time // time_window
+        continue
+      if not line.startswith('tick,'):
+        continue
+      while next_event < len(events) and events[next_event][0] < line_offset:
+        (event_offset, add, addr, id, size) = events[next_event]
+        if add:
+          live.Insert(addr, (id, size))
+        else:
+          live.Remove(addr)
+        next_event += 1
+      fields = line.rstrip().split(',')
+      pc = int(fields[1], 16)
+      if included_state is not None and int(fields[3]) != included_state:
+        excluded += 1
+        continue
+      total += 1
+      frame = FindFrame(pc)
+      if len(fields) > 4:
+        # Return addresses can be just past the end of the calling code.
+        stack = [frame] + [FindFrame(addr - 1) for addr in ParseStack(fields)]
+        if len(stack) > 1:
+          stacks.append(stack)
+          if time_window is not None:
+            stack_windows.append(window)
+          continue
+      if frame is None:
+        unaccounted += 1
+      elif isinstance(frame, tuple):
+        id = frame[1]
+        js_counts[id] = js_counts.get(id, 0) + 1
+      else:
+        cpp_ticks.append(pc)
+        if time_window is not None:
+          cpp_windows.append(window)
+        continue
+      if time_window is not None:
+        key = (window, frame)
+        window_counts[key] = window_counts.get(key, 0) + 1
+  finally:
+    logfile.close()
+  cpp_index = AddressIndex(cpp_starts)
+  cpp_counts = cpp_index.Count(cpp_ticks)
+  if time_window is not None:
+    for (window, i) in zip(cpp_windows, cpp_index.Find(cpp_ticks)):
+      key = (window, ('cpp', i))
+      window_counts[key] = window_counts.get(key, 0) + 1
+  # The ticks without stacks are paths of one frame.
+  path_counts = {}
+  for (i, count) in cpp_counts.items():
+    path_counts[(('cpp', i),)] = count
+  for (id, count) in js_counts.items():
+    path_counts[(('js', id),)] = count
+  if unaccounted:
+    path_counts[(None,)] = unaccounted
+  # Resolve the C++ frames of the stacks to ('cpp', i) and count the
+  # distinct paths and the code the ticks fell in.
+  addresses = [frame for stack in stacks for frame in stack
+               if frame is not None and not isinstance(frame, tuple)]
+  found = iter(cpp_index.Find(addresses))
+  for (n, stack) in enumerate(stacks):
+    path = []
+    for frame in stack:
+      if frame is not None and not isinstance(frame, tuple):
+        frame = ('cpp', next(found))
+      path.append(frame)
+    path = tuple(path)
+    path_counts[path] = path_counts.get(path, 0) + 1
+    if time_window is not None:
+      key = (stack_windows[n], path[0])
+      window_counts[key] = window_counts.get(key, 0) + 1
+    if path[0] is None:
+      unaccounted += 1
+    elif path[0][0] == 'js':
+      js_counts[path[0][1]] = js_counts.get(path[0][1], 0) + 1
+    else:
+      cpp_counts[path[0][1]] = cpp_counts.get(path[0][1], 0) + 1
+  return (total, unaccounted, excluded, cpp_counts, js_counts, path_counts,
+          len(stacks) > 0, window_counts)
+
+
 class TickProcessor(object):
 
   def __init__(self):
     self.log_file = ''
     self.deleted_code = []
-    self.vm_extent = {}
+    # The address ranges of the VM and shared libraries.  Ticks in them
+    # are resolved against the C++ entries.
+    self.vm_extent = AddressRanges()
     self.js_entries = splaytree.SplayTree()
     self.cpp_entries = splaytree.SplayTree()
     self.total_number_of_ticks = 0
     self.number_of_library_ticks = 0
     self.unaccounted_number_of_ticks = 0
     self.excluded_number_of_ticks = 0
+    # C++ symbols only change when a library is loaded, so ticks in C++
+    # code are buffered and resolved in batches against a frozen index.
+    self.cpp_index = None
+    self.cpp_ticks = []
+    # The frames of the ticks with stacks since the C++ ticks were last
+    # resolved, innermost first.  C++ frames are kept as addresses until
+    # then.  Ticks without stacks go in the call trees as paths of one
+    # frame, counted by the entry they fell in.
+    self.stack_ticks = []
+    self.leaf_ticks = {}
+    self.has_stacks = False
+    self.bottom_up_tree = CallTree()
+    self.top_down_tree = CallTree()
+    # The entry behind each name in the call trees, for the exporters.
+    self.frame_entries = {}
+    # The (start, end, name) of the shared libraries, sorted by start.
+    self.libraries = []
+    # Time markers give the milliseconds since profiling started.  With a
+    # time window set the ticks are also counted by entry name for each
+    # window, keyed by the number of the window.
+    self.current_time = 0
+    self.has_time_markers = False
+    # The log offsets and times of the markers, for the parallel mode.
+    self.time_markers = []
+    self.time_window = None
+    self.timeline_file = None
+    self.current_window = 0
+    self.window_ticks = {}
+
+  def SetTimeWindow(self, time_window, timeline_file = None):
+    """Makes the results include the entries with the most ticks in each
+    window of the given number of milliseconds, and a timeline of them in
+    CSV if a file is given."""
+    self.time_window = time_window
+    self.timeline_file = timeline_file
+
+  def GetDispatchTable(self):
+    """Returns the functions that handle the rows of each type of log
+    event, keyed by the first field of the row."""
+    def ProcessSharedLibrary(row):
+      # The buffered ticks belong to the code map as it is now.
+      self.ResolveCppTicks()
+      self.cpp_index = None
+      start = int(row[2], 16)
+      end = int(row[3], 16)
+      self.AddSharedLibraryEntry(row[1], start, end)
+      self.ParseVMSymbols(row[1], start, end)
+    return {
+      'tick': lambda row:
+          self.ProcessTick(int(row[1], 16), int(row[2], 16), int(row[3]),
+                           ParseStack(row)),
+      'code-creation': lambda row:
+          self.ProcessCodeCreation(row[1], int(row[2], 16), int(row[3]), row[4]),
+      'code-move': lambda row:
+          self.ProcessCodeMove(int(row[1], 16), int(row[2], 16)),
+      'code-delete': lambda row:
+          self.ProcessCodeDelete(int(row[1], 16)),
+      'shared-library': ProcessSharedLibrary,
+      'time-marker': lambda row:
+          self.ProcessTimeMarker(int(row[1]))
+    }
 
   def ProcessLogfile(self, filename, included_state = None):
     self.log_file = filename
     self.included_state = included_state
     try:
-      logfile = open(filename, 'rb')
-    except IOError:
+      log = LogInput(filename)
+    except (IOError, OSError):
       sys.exit("Could not open logfile: " + filename)
+    report_progress = (log.size is not None and log.size >= PROGRESS_MIN_SIZE
+                       and sys.stderr.isatty())
+    dispatch_table = self.GetDispatchTable()
     try:
-      logreader = csv.reader(logfile)
-      for row in logreader:
-        if row[0] == 'tick':
-          self.ProcessTick(int(row[1], 16), int(row[2], 16), int(row[3]))
-        elif row[0] == 'code-creation':
-          self.ProcessCodeCreation(row[1], int(row[2], 16), int(row[3]), row[4])
+      # The log is processed a row at a time so only the code map is
+      # kept in memory, however large the log.
+      rows = 0
+      for row in csv.reader(log.file):
+        if not row:
+          continue
+        handler = dispatch_table.get(row[0])
+        if handler:
+          handler(row)
+        rows += 1
+        if report_progress and rows % PROGRESS_INTERVAL == 0:
+          sys.stderr.write('\rProcessed %d%% of %s' %
+                           (log.GetProgress() * 100, filename))
+      self.ResolveCppTicks()
+      self.WaitForVMSymbols()
+      if report_progress:
+        sys.stderr.write('\r' + (' ' * (len(filename) + 20)) + '\r')
+    finally:
+      log.Close()
+
+  def ScanCodeEvents(self, filename):
+    """The first pass of the parallel mode: processes the shared library
+    events and time markers of a log and replays its code events into a
+    CodeVersions."""
+    code = CodeVersions()
+    logfile = open(filename, 'rb')
+    try:
+      offset = 0
+      for line in logfile:
+        line_offset = offset
+        offset += len(line)
+        if line.startswith('tick,'):
+          continue
+        rows = list(csv.reader([line]))
+        if not rows or not rows[0]:
+          continue
+        row = rows[0]
+        if row[0] == 'code-creation':
+          code.Create(line_offset, row[1], int(row[2], 16), int(row[3]), row[4])
         elif row[0] == 'code-move':
-          self.ProcessCodeMove(int(row[1], 16), int(row[2], 16))
+          code.Move(line_offset, int(row[1], 16), int(row[2], 16))
         elif row[0] == 'code-delete':
-          self.ProcessCodeDelete(int(row[1], 16))
+          code.Delete(line_offset, int(row[1], 16))
         elif row[0] == 'shared-library':
-          self.AddSharedLibraryEntry(row[1], int(row[2], 16), int(row[3], 16))
-          self.ParseVMSymbols(row[1], int(row[2], 16), int(row[3], 16))
+          start = int(row[2], 16)
+          end = int(row[3], 16)
+          self.AddSharedLibraryEntry(row[1], start, end)
+          self.ParseVMSymbols(row[1], start, end)
+        elif row[0] == 'time-marker':
+          self.current_time = max(self.current_time, int(row[1]))
+          self.has_time_markers = True
+          self.time_markers.append((line_offset, self.current_time))
     finally:
       logfile.close()
+    return code
+
+  def SplitLog(self, filename, size, count):
+    """Returns the offsets of the starts of lines that split a log into
+    about the given number of chunks."""
+    begins = [0]
+    logfile = open(filename, 'rb')
+    try:
+      for i in range(1, count):
+        logfile.seek(size * i // count)
+        logfile.readline()
+        begin = logfile.tell()
+        if begin > begins[-1] and begin < size:
+          begins.append(begin)
+    finally:
+      logfile.close()
+    return begins
+
+  def ProcessLogfileInParallel(self, filename, included_state = None):
+    """Processes a log in two passes.  The first reads the code events
+    into a versioned code map, the second resolves the ticks in chunks
+    of the log in a pool of processes.  Unlike the sequential mode it
+    only attributes a tick to JavaScript code that covers it and it uses
+    the symbols of all libraries for the whole log.  Compressed and piped
+    logs can't be split so they are processed sequentially."""
+    if filename == '-' or filename.endswith('.gz') or filename.endswith('.xz'):
+      self.ProcessLogfile(filename, included_state)
+      return
+    self.log_file = filename
+    self.included_state = included_state
+    try:
+      size = os.path.getsize(filename)
+    except OSError:
+      sys.exit("Could not open logfile: " + filename)
+    code = self.ScanCodeEvents(filename)
+    live = code.Finish(size)
+    self.WaitForVMSymbols()
+    self.cpp_index = SymbolIndex(self.cpp_entries)
+    begins = self.SplitLog(filename, size, multiprocessing.cpu_count() * 4)
+    ends = begins[1:] + [size]
+    extent = (self.vm_extent.starts, self.vm_extent.ends)
+    marker_offsets = [offset for (offset, time) in self.time_markers]
+    tasks = []
+    for (begin, end, versions) in zip(begins, ends, code.SplitVersions(begins)):
+      # The time of the last marker before the chunk.
+      i = bisect.bisect_left(marker_offsets, begin)
+      if i > 0:
+        start_time = self.time_markers[i - 1][1]
+      else:
+        start_time = 0
+      tasks.append((filename, begin, end, versions, self.cpp_index.starts,
+                    extent, included_state, start_time, self.time_window))
+    pool = multiprocessing.Pool()
+    try:
+      results = pool.map(ProcessTickChunk, tasks)
+    finally:
+      pool.close()
+      pool.join()
+    def GetFrameEntry(frame):
+      if frame is None:
+        return None
+      (kind, i) = frame
+      if kind == 'js':
+        return code.entries[i]
+      if i == 0:
+        return None
+      return self.cpp_index.entries[i - 1]
+    for (total, unaccounted, excluded, cpp_counts, js_counts, path_counts,
+         has_stacks, window_counts) in results:
+      self.total_number_of_ticks += total
+      self.unaccounted_number_of_ticks += unaccounted
+      self.excluded_number_of_ticks += excluded
+      self.has_stacks = self.has_stacks or has_stacks
+      for (path, count) in path_counts.items():
+        self.AddStack([GetFrameEntry(frame) for frame in path], count)
+      for ((window, frame), count) in window_counts.items():
+        ticks = self.window_ticks.setdefault(window, {})
+        name = GetEntryName(GetFrameEntry(frame))
+        ticks[name] = ticks.get(name, 0) + count
+      for (i, count) in cpp_counts.items():
+        if i == 0:
+          self.unaccounted_number_of_ticks += count
+          continue
+        entry = self.cpp_index.entries[i - 1]
+        if entry.IsSharedLibraryEntry():
+          self.number_of_library_ticks += count
+        entry.IncrementTickCount(count)
+      for (id, count) in js_counts.items():
+        code.entries[id].IncrementTickCount(count)
+    # Leave the code map as the sequential mode does.
+    for id in live:
+      entry = code.entries[id]
+      self.js_entries.Insert(entry.start_addr, entry)
+    for id in code.deleted:
+      if code.entries[id].tick_count > 0:
+        self.deleted_code.append(code.entries[id])
 
   def AddSharedLibraryEntry(self, filename, start, end):
     # Mark the pages used by this library.
-    i = start
-    while i < end:
-      page = i >> 12
-      self.vm_extent[page] = 1
-      i += 4096
+    self.AddVMExtent(start, end)
     # Add the library to the entries so that ticks for which we do not
     # have symbol information is reported as belonging to the library.
     self.cpp_entries.Insert(start, SharedLibraryEntry(start, filename))
+    bisect.insort(self.libraries, (start, end, filename))
+
+  def AddVMExtent(self, start, end):
+    """Marks the pages spanned by the given addresses as VM code."""
+    page_mask = ~(PAGE_SIZE - 1)
+    self.vm_extent.Add(start & page_mask, (end + PAGE_SIZE - 1) & page_mask)
 
   def ParseVMSymbols(self, filename, start, end):
     return
 
+  def WaitForVMSymbols(self):
+    """Called before the cpp entries are used, for symbols that are
+    extracted in the background."""
+    return
+
   def ProcessCodeCreation(self, type, addr, size, name):
     self.js_entries.Insert(addr, JSCodeEntry(addr, name, type, size))
 
@@ -127,37 +788,138 @@ class TickProcessor(object):
       removed_node = self.js_entries.Remove(from_addr)
       removed_node.value.SetStartAddress(to_addr);
       self.js_entries.Insert(to_addr, removed_node.value)
-    except 'KeyNotFound':
+    except splaytree.KeyNotFound:
       print('Code move event for unknown code: 0x%x' % from_addr)
 
   def ProcessCodeDelete(self, from_addr):
     try:
       removed_node = self.js_entries.Remove(from_addr)
-      self.deleted_code.append(removed_node.value)
-    except 'KeyNotFound':
+      # Only code that was ticked in shows up in the results.
+      if removed_node.value.tick_count > 0:
+        self.deleted_code.append(removed_node.value)
+    except splaytree.KeyNotFound:
       print('Code delete event for unknown code: 0x%x' % from_addr)
 
+  def ProcessTimeMarker(self, time):
+    # The clock the markers come from can be set back.
+    self.current_time = max(self.current_time, time)
+    self.has_time_markers = True
+    if self.time_window is None:
+      return
+    window = self.current_time // self.time_window
+    if window != self.current_window:
+      # The buffered ticks were taken during the previous window.
+      self.ResolveCppTicks()
+      self.current_window = window
+
   def IncludeTick(self, pc, sp, state):
     return (self.included_state is None) or (self.included_state == state)
 
-  def ProcessTick(self, pc, sp, state):
+  def ProcessTick(self, pc, sp, state, stack = ()):
     if not self.IncludeTick(pc, sp, state):
       self.excluded_number_of_ticks += 1;
       return
     self.total_number_of_ticks += 1
-    page = pc >> 12
-    if page in self.vm_extent:
-      entry = self.cpp_entries.FindGreatestsLessThan(pc).value
-      if entry.IsSharedLibraryEntry():
-        self.number_of_library_ticks += 1
-      entry.IncrementTickCount()
-      return
-    max = self.js_entries.FindMax()
-    min = self.js_entries.FindMin()
-    if max != None and pc < max.key and pc > min.key:
-      self.js_entries.FindGreatestsLessThan(pc).value.IncrementTickCount()
-      return
-    self.unaccounted_number_of_ticks += 1
+    if self.vm_extent.Contains(pc):
+      if stack:
+        frame = pc
+      else:
+        self.cpp_ticks.append(pc)
+        if len(self.cpp_ticks) >= TICK_BATCH_SIZE:
+          self.ResolveCppTicks()
+        return
+    else:
+      frame = None
+      max = self.js_entries.FindMax()
+      min = self.js_entries.FindMin()
+      if max != None and pc < max.key and pc > min.key:
+        frame = self.js_entries.FindGreatestsLessThan(pc).value
+        frame.IncrementTickCount()
+      else:
+        self.unaccounted_number_of_ticks += 1
+      if not stack:
+        self.leaf_ticks[frame] = self.leaf_ticks.get(frame, 0) + 1
+        return
+    # JavaScript code can move, so the frames are looked up now.  Return
+    # addresses can be just past the end of the calling code.
+    frames = [frame]
+    for addr in stack:
+      frames.append(self.FindFrame(addr - 1))
+    self.has_stacks = True
+    self.stack_ticks.append(frames)
+    if len(self.stack_ticks) >= TICK_BATCH_SIZE:
+      self.ResolveCppTicks()
+
+  def FindFrame(self, addr):
+    """Returns the JavaScript entry an address is in, the address itself
+    if it is in C++ code, or None."""
+    if self.vm_extent.Contains(addr):
+      return addr
+    node = self.js_entries.FindGreatestsLessThan(addr)
+    if node and addr < node.key + node.value.size:
+      return node.value
+    return None
+
+  def ResolveCppTicks(self):
+    """Adds the buffered ticks in C++ code to the entries they fall in
+    and the buffered stacks to the call trees."""
+    # The entries the ticks fell in, for the time windows.
+    leaves = list(self.leaf_ticks.items())
+    for (entry, count) in leaves:
+      self.AddStack([entry], count)
+    self.leaf_ticks = {}
+    if self.cpp_ticks or self.stack_ticks:
+      if self.cpp_index is None:
+        self.WaitForVMSymbols()
+        self.cpp_index = SymbolIndex(self.cpp_entries)
+      (counts, unknown) = self.cpp_index.CountAddresses(self.cpp_ticks)
+      self.cpp_ticks = []
+      if unknown:
+        self.AddStack([None], unknown)
+      for (entry, count) in counts:
+        self.AddStack([entry], count)
+      addresses = [frame for frames in self.stack_ticks for frame in frames
+                   if frame is not None and not isinstance(frame, CodeEntry)]
+      found = iter(self.cpp_index.FindEntries(addresses))
+      for frames in self.stack_ticks:
+        in_cpp = frames[0] is not None and not isinstance(frames[0], CodeEntry)
+        for i in range(len(frames)):
+          if frames[i] is not None and not isinstance(frames[i], CodeEntry):
+            frames[i] = next(found)
+        if not in_cpp:
+          leaves.append((frames[0], 1))
+        elif frames[0] is None:
+          unknown += 1
+        else:
+          counts.append((frames[0], 1))
+        self.AddStack(frames)
+      self.stack_ticks = []
+      for (entry, count) in counts:
+        if entry.IsSharedLibraryEntry():
+          self.number_of_library_ticks += count
+        entry.IncrementTickCount(count)
+      self.unaccounted_number_of_ticks += unknown
+      leaves.extend(counts)
+      if unknown:
+        leaves.append((None, unknown))
+    if self.time_window is not None:
+      window = self.window_ticks.setdefault(self.current_window, {})
+      for (entry, count) in leaves:
+        name = GetEntryName(entry)
+        window[name] = window.get(name, 0) + count
+
+  def AddStack(self, entries, count = 1):
+    """Adds the path of the given entries, innermost first, to the call
+    trees."""
+    names = []
+    for entry in entries:
+      name = GetEntryName(entry)
+      if not name in self.frame_entries:
+        self.frame_entries[name] = entry
+      names.append(name)
+    self.bottom_up_tree.AddPath(names, count)
+    names.reverse()
+    self.top_down_tree.AddPath(names, count)
 
   def PrintResults(self):
     print('Statistical profiling result from %s, (%d ticks, %d unaccounted, %d excluded).' %
@@ -178,6 +940,277 @@ class TickProcessor(object):
       # Print the C++ ticks.
       self.PrintHeader('C++')
       self.PrintEntries(cpp_entries, lambda e:not e.IsSharedLibraryEntry())
+      # Print the call trees if the log has stacks.
+      if self.has_stacks:
+        print('\n [Bottom up (heavy) profile]:')
+        print('  Callers of the functions ticks fell in, with the percentage')
+        print('  of all ticks and of the ticks of the callee.')
+        print('   total  parent   name')
+        self.PrintCallTree(self.bottom_up_tree.root, 'parent')
+        print('\n [Top down profile]:')
+        print('  Callees of the outermost functions, with the percentage of')
+        print('  all ticks inside the function and in its own code.')
+        print('   total    self   name')
+        self.PrintCallTree(self.top_down_tree.root, 'self')
+      if self.time_window is not None:
+        self.PrintTimeWindows()
+        if self.timeline_file is not None:
+          self.WriteTimeline(self.timeline_file)
+
+  def PrintCallTree(self, root, column):
+    total = root.total_ticks
+    # Walk the tree depth first without recursing, for deep stacks.
+    pending = [(root, 0, total)]
+    while pending:
+      (node, depth, parent_ticks) = pending.pop()
+      if node is not root:
+        if column == 'self':
+          second = node.self_ticks * 100.0 / total
+        else:
+          second = node.total_ticks * 100.0 / parent_ticks
+        print('  %5.1f%% %6.1f%%   %s%s' % (node.total_ticks * 100.0 / total,
+                                           second, '  ' * (depth - 1),
+                                           node.name))
+      children = [child for child in node.children.values()
+                  if child.total_ticks * 100.0 / total >= CALL_TREE_THRESHOLD]
+      # Print the heaviest child first, ties in the order of their names.
+      children.sort(key=lambda c:(-c.total_ticks, c.name))
+      children.reverse()
+      for child in children:
+        pending.append((child, depth + 1, node.total_ticks))
+
+  def PrintTimeWindows(self):
+    print('\n [Time windows]:')
+    if not self.has_time_markers:
+      print('  The log has no time markers.')
+      return
+    print('   ticks  window   name')
+    for window in sorted(self.window_ticks.keys()):
+      ticks = self.window_ticks[window]
+      total = sum(ticks.values())
+      start = window * self.time_window
+      print('\n  %d-%d ms: %d ticks' % (start, start + self.time_window, total))
+      entries = sorted(ticks.items(), key=lambda e:(-e[1], e[0]))
+      for (name, count) in entries[:TIME_WINDOW_ENTRIES]:
+        print('  %6d %6.1f%%   %s' % (count, count * 100.0 / total, name))
+
+  def WriteTimeline(self, filename):
+    """Writes the ticks in the entries with the most ticks overall for
+    each time window as CSV, with a row for every window."""
+    totals = {}
+    for ticks in self.window_ticks.values():
+      for (name, count) in ticks.items():
+        totals[name] = totals.get(name, 0) + count
+    names = sorted(totals.keys(), key=lambda n:(-totals[n], n))
+    names = names[:TIMELINE_ENTRIES]
+    try:
+      output = open(filename, 'w')
+    except IOError:
+      sys.exit("Could not open timeline file: " + filename)
+    try:
+      writer = csv.writer(output)
+      writer.writerow(['start_ms', 'ticks'] + names + ['other'])
+      last = -1
+      if self.window_ticks:
+        last = max(self.window_ticks.keys())
+      # Windows without ticks get rows too so the timeline can be plotted.
+      for window in range(last + 1):
+        ticks = self.window_ticks.get(window, {})
+        total = sum(ticks.values())
+        counts = [ticks.get(name, 0) for name in names]
+        writer.writerow([window * self.time_window, total] + counts +
+                        [total - sum(counts)])
+    finally:
+      output.close()
+
+  def GetLibrary(self, entry):
+    """Returns the (start, end, name) of the shared library the code of an
+    entry is in, or None for JavaScript code."""
+    if entry is None or isinstance(entry, JSCodeEntry):
+      return None
+    i = bisect.bisect_left(self.libraries, (entry.start_addr + 1,)) - 1
+    if i >= 0 and entry.start_addr < self.libraries[i][1]:
+      return self.libraries[i]
+    return None
+
+  def GetPaths(self):
+    """Returns the (names, ticks) of the call paths in the top-down tree
+    that ticks ended in, outermost first.  Ticks without stacks have paths
+    of one name."""
+    paths = []
+    pending = [(self.top_down_tree.root, [])]
+    while pending:
+      (node, path) = pending.pop()
+      if node.self_ticks > 0 and path:
+        paths.append((path, node.self_ticks))
+      for child in node.children.values():
+        pending.append((child, path + [child.name]))
+    paths.sort()
+    return paths
+
+  def OpenExportFile(self, filename, compress = False):
+    try:
+      if compress or filename.endswith('.gz'):
+        return gzip.open(filename, 'wb')
+      return open(filename, 'w')
+    except IOError:
+      sys.exit("Could not open export file: " + filename)
+
+  def ExportProfile(self, format, filename):
+    """Writes the profile to a file in the given format, 'pprof',
+    'callgrind' or 'folded'."""
+    exporters = {
+      'pprof': self.WritePprof,
+      'callgrind': self.WriteCallgrind,
+      'folded': self.WriteFoldedStacks
+    }
+    exporters[format](filename)
+
+  def WriteFoldedStacks(self, filename):
+    """Writes the call paths in the folded format of the flame graph
+    scripts, a line of semicolon separated names and ticks per path."""
+    output = self.OpenExportFile(filename)
+    try:
+      for (path, ticks) in self.GetPaths():
+        names = [name.replace(';', ':') for name in path]
+        output.write('%s %d\n' % (';'.join(names), ticks))
+    finally:
+      output.close()
+
+  def WriteCallgrind(self, filename):
+    """Writes the profile in the callgrind format of KCachegrind.  Each
+    function has its self ticks and, for each function it calls, the
+    ticks inside that call.  Sampled stacks don't count calls, so the
+    call counts are ticks too."""
+    self_ticks = {}
+    calls = {}
+    pending = [self.top_down_tree.root]
+    while pending:
+      node = pending.pop()
+      if node.name is not None:
+        self_ticks[node.name] = self_ticks.get(node.name, 0) + node.self_ticks
+      for child in node.children.values():
+        if node.name is not None:
+          callees = calls.setdefault(node.name, {})
+          callees[child.name] = callees.get(child.name, 0) + child.total_ticks
+        pending.append(child)
+    def GetObject(name):
+      entry = self.frame_entries.get(name)
+      library = self.GetLibrary(entry)
+      if library is not None:
+        return library[2]
+      if entry is None:
+        return UNKNOWN_FRAME
+      if isinstance(entry, JSCodeEntry):
+        return 'JavaScript'
+      return 'C++'
+    output = self.OpenExportFile(filename)
+    try:
+      output.write('# callgrind format\n')
+      output.write('version: 1\n')
+      output.write('creator: v8 tick processor\n')
+      output.write('cmd: %s\n' % self.log_file)
+      output.write('events: Ticks\n')
+      output.write('summary: %d\n' % self.top_down_tree.root.total_ticks)
+      for name in sorted(self_ticks.keys()):
+        output.write('\nob=%s\n' % GetObject(name))
+        output.write('fn=%s\n' % name)
+        output.write('0 %d\n' % self_ticks[name])
+        callees = calls.get(name, {})
+        for callee in sorted(callees.keys()):
+          output.write('cob=%s\n' % GetObject(callee))
+          output.write('cfn=%s\n' % callee)
+          output.write('calls=%d 0\n' % callees[callee])
+          output.write('0 %d\n' % callees[callee])
+    finally:
+      output.close()
+
+  def WritePprof(self, filename):
+    """Writes the profile as a gzipped pprof protocol buffer.  Every
+    function has one location.  The code of C++ functions and shared
+    libraries is mapped to its library, JavaScript code is unmapped and
+    has its type in its name."""
+    strings = {'': 0}
+    string_table = ['']
+    def GetString(string):
+      if not string in strings:
+        strings[string] = len(string_table)
+        string_table.append(string)
+      return strings[string]
+    profile = ProtoWriter()
+    for (type, unit) in (('samples', 'count'), ('cpu', 'nanoseconds')):
+      value_type = ProtoWriter()
+      value_type.Int(1, GetString(type))
+      value_type.Int(2, GetString(unit))
+      profile.Message(1, value_type)
+    mapping_ids = {}
+    location_ids = {}
+    functions = ProtoWriter()
+    for (path, ticks) in self.GetPaths():
+      for name in path:
+        if name in location_ids:
+          continue
+        entry = self.frame_entries.get(name)
+        library = self.GetLibrary(entry)
+        if library is not None and not library in mapping_ids:
+          mapping_ids[library] = len(mapping_ids) + 1
+          mapping = ProtoWriter()
+          mapping.Int(1, mapping_ids[library])
+          mapping.Int(2, library[0])
+          mapping.Int(3, library[1])
+          mapping.Int(5, GetString(library[2]))
+          mapping.Int(7, 1)
+          profile.Message(3, mapping)
+        id = len(location_ids) + 1
+        location_ids[name] = id
+        function = ProtoWriter()
+        function.Int(1, id)
+        function.Int(2, GetString(name))
+        if entry is not None:
+          function.Int(3, GetString(entry.name))
+        if library is not None:
+          function.Int(4, GetString(library[2]))
+        functions.Message(5, function)
+        line = ProtoWriter()
+        line.Int(1, id)
+        location = ProtoWriter()
+        location.Int(1, id)
+        if library is not None:
+          location.Int(2, mapping_ids[library])
+        location.Message(4, line)
+        profile.Message(4, location)
+    for (path, ticks) in self.GetPaths():
+      sample = ProtoWriter()
+      # The locations of a sample go from the innermost out.
+      sample.PackedInts(1, [location_ids[name] for name in reversed(path)])
+      sample.PackedInts(2, [ticks, ticks * TICK_INTERVAL])
+      profile.Message(2, sample)
+    profile.data.extend(functions.data)
+    period_type = ProtoWriter()
+    period_type.Int(1, GetString('cpu'))
+    period_type.Int(2, GetString('nanoseconds'))
+    profile.Message(11, period_type)
+    profile.Int(12, TICK_INTERVAL)
+    for string in string_table:
+      profile.String(6, string)
+    output = self.OpenExportFile(filename, True)
+    try:
+      output.write(bytes(profile.data))
+    finally:
+      output.close()
+
+  def GetTicksByName(self):
+    """Returns a dictionary of the ticks in the entries with ticks, keyed
+    by their names rather than addresses so that profiles of different
+    binaries can be compared."""
+    ticks = {}
+    entries = self.js_entries.ExportValueList() + self.deleted_code
+    entries.extend(self.cpp_entries.ExportValueList())
+    for entry in entries:
+      if entry.tick_count > 0:
+        name = entry.ToString()
+        ticks[name] = ticks.get(name, 0) + entry.tick_count
+    return ticks
 
   def PrintHeader(self, header_title):
     print('\n [%s]:' % header_title)
@@ -200,5 +1233,74 @@ class TickProcessor(object):
           'name' : entry.ToString()
         })
 
+def GetZScore(old_ticks, old_total, new_ticks, new_total):
+  """Returns the z score of the change in the share of the ticks of an
+  entry between two profiles, from a two-proportion z-test."""
+  share = float(old_ticks + new_ticks) / (old_total + new_total)
+  variance = share * (1 - share) * (1.0 / old_total + 1.0 / new_total)
+  if variance == 0:
+    return 0.0
+  change = float(new_ticks) / new_total - float(old_ticks) / old_total
+  return change / math.sqrt(variance)
+
+
+def PrintProfileDiff(old, new):
+  """Prints the entries whose share of the ticks changed the most between
+  two processed profiles, by absolute and by relative change."""
+  print('Statistical profiling difference from %s (%d ticks) to %s (%d ticks).' %
+        (old.log_file, old.total_number_of_ticks,
+         new.log_file, new.total_number_of_ticks))
+  if old.total_number_of_ticks == 0 or new.total_number_of_ticks == 0:
+    return
+  old_ticks = old.GetTicksByName()
+  new_ticks = new.GetTicksByName()
+  old_total = old.total_number_of_ticks
+  new_total = new.total_number_of_ticks
+  changes = []
+  for name in set(old_ticks.keys()) | set(new_ticks.keys()):
+    old_count = old_ticks.get(name, 0)
+    new_count = new_ticks.get(name, 0)
+    old_share = old_count * 100.0 / old_total
+    new_share = new_count * 100.0 / new_total
+    if old_count == 0:
+      relative = None
+    else:
+      relative = (new_share - old_share) * 100.0 / old_share
+    z = GetZScore(old_count, old_total, new_count, new_total)
+    changes.append((name, old_count + new_count, old_share, new_share,
+                    relative, z))
+  print('  Shares are of all ticks.  Changes marked * have |z| >= %.2f.' %
+        DIFF_SIGNIFICANT_Z)
+  # Print the largest changes in share.
+  changes.sort(key=lambda c:(-abs(c[3] - c[2]), c[0]))
+  PrintDiffEntries('Largest absolute changes', changes[:DIFF_ENTRIES])
+  # Print the largest relative changes of entries with enough ticks,
+  # new entries first.
+  changes = [c for c in changes if c[1] >= DIFF_MIN_TICKS]
+  def RelativeKey(change):
+    if change[4] is None:
+      return (0, -change[3], change[0])
+    return (1, -abs(change[4]), change[0])
+  changes.sort(key=RelativeKey)
+  PrintDiffEntries('Largest relative changes', changes[:DIFF_ENTRIES])
+
+
+def PrintDiffEntries(title, changes):
+  print('\n [%s]:' % title)
+  print('     old     new   change  relative       z   name')
+  for (name, ticks, old_share, new_share, relative, z) in changes:
+    if relative is None:
+      relative = 'new'
+    else:
+      relative = '%+.1f%%' % relative
+    if abs(z) >= DIFF_SIGNIFICANT_Z:
+      mark = '*'
+    else:
+      mark = ' '
+    print('  %5.1f%%  %5.1f%%  %+6.1f%%  %8s  %6.1f %s %s' %
+          (old_share, new_share, new_share - old_share, relative, z, mark,
+           name))
+
+
 if __name__ == '__main__':
   sys.exit('You probably want to run windows-tick-processor.py or linux-tick-processor.py.')
@@ -31,7 +31,9 @@
 # Usage: process-ticks.py <binary> <logfile>
 #
 # Where <binary> is the binary program name (eg, v8_shell.exe) and
-# <logfile> is the log file name (eg, v8.log).
+# <logfile> is the log file name (eg, v8.log).  Logs compressed with
+# gzip or xz are read if their names end in .gz or .xz and '-' reads the
+# log from stdin.
 #
 # This tick processor expects to find a map file for the binary named
 # binary.map if the binary is named binary.exe. The tick processor
@@ -98,24 +100,26 @@ class WindowsTickProcessor(tickprocessor.TickProcessor):
           mangled_name = row.group(1)
           name = self.Unmangle(mangled_name)
           self.cpp_entries.Insert(addr, tickprocessor.CodeEntry(addr, name));
-      i = min_addr
       # Mark the pages for which there are functions in the map file.
-      while i < max_addr:
-        page = i >> 12
-        self.vm_extent[page] = 1
-        i += 4096
+      self.AddVMExtent(min_addr, max_addr)
     finally:
       map_file.close()
 
 def Usage():
-  print("Usage: windows-tick-processor.py binary logfile-name");
+  print("Usage: windows-tick-processor.py [--parallel] [--window=ms] [--timeline=csv-file] [--pprof=file] [--callgrind=file] [--folded=file] binary logfile-name|-");
+  print("       windows-tick-processor.py [--parallel] --diff old-binary old-logfile-name new-binary new-logfile-name");
   sys.exit(2)
 
 def Main():
   # parse command line options
   state = None;
+  parallel = False
+  time_window = None
+  timeline_file = None
+  diff = False
+  exports = []
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "jgco", ["js", "gc", "compiler", "other"])
+    opts, args = getopt.getopt(sys.argv[1:], "jgcop", ["js", "gc", "compiler", "other", "parallel", "window=", "timeline=", "diff", "pprof=", "callgrind=", "folded="])
   except getopt.GetoptError:
     usage()
   # process options.
@@ -128,13 +132,46 @@ def Main():
       state = 2
     if key in ("-o", "--other"):
       state = 3
+    if key in ("-p", "--parallel"):
+      parallel = True
+    if key == "--window":
+      try:
+        time_window = int(value)
+      except ValueError:
+        Usage()
+      if time_window <= 0:
+        Usage()
+    if key == "--timeline":
+      timeline_file = value
+    if key == "--diff":
+      diff = True
+    if key in ("--pprof", "--callgrind", "--folded"):
+      exports.append((key, value))
+  if timeline_file is not None and time_window is None:
+    time_window = 1000
   # do the processing.
+  def ProcessLog(binary, filename):
+    tick_processor = WindowsTickProcessor()
+    if time_window is not None and not diff:
+      tick_processor.SetTimeWindow(time_window, timeline_file)
+    tick_processor.ParseMapFile(binary)
+    if parallel:
+      tick_processor.ProcessLogfileInParallel(filename, state)
+    else:
+      tick_processor.ProcessLogfile(filename, state)
+    return tick_processor
+  if diff:
+    if len(args) != 4:
+      Usage();
+    tickprocessor.PrintProfileDiff(ProcessLog(args[0], args[1]),
+                                   ProcessLog(args[2], args[3]))
+    return
   if len(args) != 2:
       Usage();
-  tickprocessor = WindowsTickProcessor()
-  tickprocessor.ParseMapFile(args[0])
-  tickprocessor.ProcessLogfile(args[1], state)
-  tickprocessor.PrintResults()
+  tick_processor = ProcessLog(args[0], args[1])
+  tick_processor.PrintResults()
+  for (key, value) in exports:
+    tick_processor.ExportProfile(key[2:], value)
 
 if __name__ == '__main__':
   Main()